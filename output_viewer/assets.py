@@ -0,0 +1,55 @@
+import hashlib
+import os
+from .utils import dir_checksum
+
+
+STATIC_DIR = os.path.join(os.path.abspath(os.path.dirname(__file__)), "static")
+_static_checksum = None
+_fingerprints = None
+
+
+def static_checksum():
+    """
+    Checksum of the packaged static assets; computed once per process.
+    """
+    global _static_checksum
+    if _static_checksum is None:
+        _static_checksum = dir_checksum(STATIC_DIR)
+    return _static_checksum
+
+
+def fingerprinted_name(name, content):
+    """
+    name with a hash of content before its extension, e.g. viewer.js -> viewer.0123456789.js.
+    """
+    base, ext = os.path.splitext(name)
+    return "%s.%s%s" % (base, hashlib.sha1(content).hexdigest()[:10], ext)
+
+
+def static_fingerprints():
+    """
+    Map of the path of each packaged static asset (relative to STATIC_DIR, with "/"
+    separators) to its fingerprinted path; computed once per process.
+
+    The viewer directory has a copy of each asset under both names (see
+    build.copy_and_edit_path), and pages link to the fingerprinted one, so
+    they can be cached indefinitely.
+    """
+    global _fingerprints
+    if _fingerprints is None:
+        fingerprints = {}
+        for dirpath, _, files in os.walk(STATIC_DIR):
+            for f in files:
+                with open(os.path.join(dirpath, f), "rb") as fp:
+                    content = fp.read()
+                name = os.path.relpath(os.path.join(dirpath, f), STATIC_DIR).replace(os.sep, "/")
+                fingerprints[name] = fingerprinted_name(name, content)
+        _fingerprints = fingerprints
+    return _fingerprints
+
+
+def static_url(name):
+    """
+    The fingerprinted path of the static asset name (e.g. "js/viewer.js"), or name itself if it isn't packaged.
+    """
+    return static_fingerprints().get(name, name)
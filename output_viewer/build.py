@@ -1,72 +1,394 @@
 from .htmlbuilder import Document, BootstrapNavbar, Table, Link
 import shutil
+import marshal
 import json
 import sys
 from .page import Page
 from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 import datetime
 import os
 import stat
-from .utils import rechmod
+import tempfile
+from .utils import rechmod, link_or_copy, swap_in, move_in, remove_path, FileSnapshot
+from .assets import STATIC_DIR, static_checksum, static_fingerprints
+from .profiling import BuildProfile, NULL_PROFILE
+from .output import OutputWriter
+from .manifest import BuildManifest, invalidate_page, spec_hash
+from .thumbnails import ThumbnailCache, image_paths, thumbnails_available
+from .streaming import read_header, iter_plotspecs
 
 
-def open_specs(index_path):
+# The most recently parsed index file, keyed by absolute path; see _load_specs
+_spec_cache = {}
+
+
+def clear_spec_cache():
     """
-    Open return the specs json at index_path.
+    Drop the cached index (see _load_specs), so the memory it holds can be reclaimed.
+    """
+    _spec_cache.clear()
+
+
+def _load_specs(index_path, sidecar=False, cache=True, default_mask=None):
     """
+    Return (spec, plotspecs by short_name) for index_path.
+
+    With cache=True, the parsed spec is kept in-process and reused as long as the
+    file's mtime and size are unchanged. Only one index is kept at a time; call
+    clear_spec_cache to drop it. With sidecar=True, the parsed spec is also saved
+    next to the index (as index.json.marshal, with default_mask applied) so other
+    processes can skip parsing the JSON. It's marshalled rather than pickled, since
+    loading a pickle someone else could have written would run their code.
+    """
+    abs_path = os.path.abspath(index_path)
     try:
-        with open(index_path) as index_file:
-            return json.load(index_file)
-    except:
-        print(("Unable to load index file at '%s'. Please make sure it's a valid JSON file." % index_path))
-        sys.exit()
+        st = os.stat(abs_path)
+        key = (st.st_mtime_ns, st.st_size)
+    except OSError:
+        key = None
+
+    cached = _spec_cache.get(abs_path)
+    if cached is not None and key is not None and cached[0] == key:
+        return cached[1], cached[2]
+
+    spec = None
+    sidecar_path = abs_path + ".marshal"
+    if sidecar and key is not None:
+        try:
+            with open(sidecar_path, "rb") as sidecar_file:
+                sidecar_key, sidecar_spec = marshal.load(sidecar_file)
+            if tuple(sidecar_key) == key and isinstance(sidecar_spec, dict):
+                spec = sidecar_spec
+        except Exception:
+            # Missing, stale, or unreadable; fall back to the JSON.
+            pass
+
+    if spec is None:
+        try:
+            with open(index_path) as index_file:
+                spec = json.load(index_file)
+        except:
+            print(("Unable to load index file at '%s'. Please make sure it's a valid JSON file." % index_path))
+            sys.exit()
+        if sidecar and key is not None:
+            # Replaced in one go, so other processes never read it half-written
+            tmp_path = "%s.tmp-%d" % (sidecar_path, os.getpid())
+            try:
+                with open(tmp_path, "wb") as sidecar_file:
+                    marshal.dump((key, spec), sidecar_file)
+                if default_mask is not None:
+                    os.chmod(tmp_path, default_mask)
+                os.replace(tmp_path, sidecar_path)
+            except (IOError, OSError, ValueError):
+                remove_path(tmp_path)
 
-def copy_and_edit_path(path, default_mask):
+    by_short_name = {}
+    for plotspec in spec.get("specification", []):
+        by_short_name[plotspec.get("short_name")] = plotspec
+
+    if cache and key is not None:
+        _spec_cache.clear()
+        _spec_cache[abs_path] = (key, spec, by_short_name)
+    return spec, by_short_name
+
+
+def open_specs(index_path, sidecar=False):
+    """
+    Open return the specs json at index_path.
+
+    The result is cached (see _load_specs), so callers shouldn't modify it.
+    """
+    return _load_specs(index_path, sidecar)[0]
+
+# Written into the viewer directory to record which static assets it holds
+STAMP_NAME = ".checksum"
+# Written into the viewer directory to list the fingerprinted names it was made with
+FINGERPRINTS_NAME = ".fingerprints"
+
+
+def copy_and_edit_path(path, default_mask, link_assets=None, compress=False, profile=NULL_PROFILE):
     """
     At the given path, copy it and modify it
     so its contents can be viewed correctly.
+
+    Each asset is also given a fingerprinted name (see assets.static_fingerprints),
+    which is what pages link to, so they can be served with long-lived cache headers.
+
+    The viewer directory is only refreshed when the packaged static assets (or
+    the permissions/link mode) differ from the ones it was last made with, and
+    is swapped in with renames so pages are never left without their assets.
+    The previous fingerprinted files are kept through one refresh, so pages
+    that haven't been rebuilt (or published, for a staged build) yet still work.
+
+    link_assets can be "hardlink" or "symlink" to link to the packaged assets
+    instead of copying them; default_mask isn't applied to linked assets, since
+    that would change the permissions of the installed package's files.
+
+    If compress is True, the assets get gzipped copies next to them (see
+    output.OutputWriter).
     """
-    static_dir = os.path.join(os.path.abspath(os.path.dirname(__file__)), "static")
     viewer_dir = os.path.join(path, "viewer")
 
-    if os.path.exists(viewer_dir):
-        shutil.rmtree(viewer_dir)
+    if link_assets == "hardlink":
+        copy_function = link_or_copy
+    elif link_assets == "symlink":
+        copy_function = os.symlink
+    elif link_assets in (None, "copy"):
+        copy_function = shutil.copy2
+    else:
+        raise ValueError("Unknown link_assets mode '%s'" % link_assets)
 
-    shutil.copytree(static_dir, viewer_dir)
+    if link_assets is not None and link_assets != "copy":
+        default_mask = None
+    stamp = "%s %s %s fingerprinted%s" % (static_checksum(), link_assets or "copy", default_mask,
+                                          " gzip" if compress else "")
+    stamp_path = os.path.join(viewer_dir, STAMP_NAME)
+    if not os.path.islink(viewer_dir) and os.path.exists(stamp_path):
+        with open(stamp_path) as stamp_file:
+            if stamp_file.read() == stamp:
+                return
+
+    new_dir = "%s.new-%d" % (viewer_dir, os.getpid())
+    remove_path(new_dir)
+    shutil.copytree(STATIC_DIR, new_dir, copy_function=copy_function)
+    if compress:
+        OutputWriter(compress=True).compress_tree(new_dir, profile)
+    fingerprinted_names = []
+    for name, fingerprinted in static_fingerprints().items():
+        if link_assets == "symlink":
+            os.symlink(os.path.join(STATIC_DIR, name), os.path.join(new_dir, fingerprinted))
+        else:
+            link_or_copy(os.path.join(new_dir, name), os.path.join(new_dir, fingerprinted))
+        fingerprinted_names.append(fingerprinted)
+        if os.path.exists(os.path.join(new_dir, name + ".gz")):
+            link_or_copy(os.path.join(new_dir, name + ".gz"), os.path.join(new_dir, fingerprinted + ".gz"))
+            fingerprinted_names.append(fingerprinted + ".gz")
+
+    _keep_fingerprinted(viewer_dir, new_dir)
+    with open(os.path.join(new_dir, FINGERPRINTS_NAME), "w") as fingerprints_file:
+        fingerprints_file.write("\n".join(fingerprinted_names))
+    with open(os.path.join(new_dir, STAMP_NAME), "w") as stamp_file:
+        stamp_file.write(stamp)
 
     if default_mask is not None:
-        rechmod(viewer_dir, default_mask)
+        rechmod(new_dir, default_mask)
+
+    swap_in(new_dir, viewer_dir)
 
-def build_page(output_page, index_path="index.json", default_mask=None):
+
+def _keep_fingerprinted(viewer_dir, new_dir):
+    """
+    Carry the fingerprinted files that viewer_dir was made with over into new_dir,
+    where they aren't there already; pages built against the old assets link to them.
+    """
+    if os.path.islink(viewer_dir):
+        return
+    try:
+        with open(os.path.join(viewer_dir, FINGERPRINTS_NAME)) as fingerprints_file:
+            names = fingerprints_file.read().split("\n")
+    except (IOError, OSError):
+        return
+    for name in names:
+        old = os.path.join(viewer_dir, name)
+        new = os.path.join(new_dir, name)
+        if not name or os.path.lexists(new) or not os.path.lexists(old):
+            continue
+        if not os.path.isdir(os.path.dirname(new)):
+            os.makedirs(os.path.dirname(new))
+        if os.path.islink(old):
+            os.symlink(os.readlink(old), new)
+        else:
+            link_or_copy(old, new)
+
+BUILD_MODES = ("pages", "lazy", "spa")
+
+
+def _build(page, page_name, toolbar, mode):
+    """
+    Build page into page_name in the given mode; see build_viewer.
+    """
+    if mode == "spa":
+        page.build_spa(page_name, toolbar)
+    elif mode == "pages":
+        page.build(page_name, toolbar)
+    elif mode == "lazy":
+        page.build(page_name, toolbar, lazy=True)
+    else:
+        raise ValueError("Unknown build mode '%s'; expected one of %s" % (mode, ", ".join(BUILD_MODES)))
+
+
+def _get_profile(profile):
+    if profile is True:
+        return BuildProfile()
+    if profile is None or profile is False:
+        return NULL_PROFILE
+    return profile
+
+
+def build_page(output_page, index_path="index.json", default_mask=None, column_workers=None, link_assets=None,
+               sidecar=False, mode="pages", profile=None, minify=False, compress=False, diff=False, thumbnails=False):
     """
     Given an OutputPage object, generate and return the
     location of the HTML page.
+
+    If column_workers is greater than 1, column pages are built on that many threads.
+    link_assets is passed along to copy_and_edit_path, and sidecar to open_specs.
+    mode, minify, compress, diff and thumbnails are the same as for build_viewer. Pass a
+    profiling.BuildProfile as profile to record where the build spends its time; since
+    the page's path is what's returned, profile=True isn't accepted.
     """
-    spec = open_specs(index_path)
-    spec = spec["specification"]
+    if profile is True:
+        raise ValueError("build_page returns the page's path, so pass a BuildProfile to record into instead of True")
+    profile = _get_profile(profile)
+    with profile.phase("load"):
+        _, by_short_name = _load_specs(index_path, sidecar, default_mask=default_mask)
 
     path = os.path.dirname(index_path)
 
-    page_path = None
-    for plotspec in spec:
-        if plotspec['short_name'] == output_page.short_name:
-            page = Page(plotspec, root_path=path, permissions=default_mask)
-            page.build(page.short_name)
-            page_path = os.path.join(page.short_name, "index.html")
-
-    if not page_path:
+    plotspec = by_short_name.get(output_page.short_name)
+    if plotspec is None:
         msg = "The current page's name isn't in the specs json."
         raise RuntimeError(msg)
 
-    copy_and_edit_path(path, default_mask)
+    page = Page(plotspec, root_path=path, permissions=default_mask, column_workers=column_workers, profile=profile,
+                writer=OutputWriter(minify, compress, diff))
+    if thumbnails and thumbnails_available():
+        thumbnail_cache = ThumbnailCache(path, default_mask=default_mask)
+        try:
+            with profile.phase("thumbnails"):
+                page.thumbnails = thumbnail_cache.thumbnails(image_paths(plotspec))
+        finally:
+            thumbnail_cache.close()
+    _build(page, page.short_name, None, mode)
+    page_path = os.path.join(page.short_name, "index.html")
+    # Built without the navbar, so it doesn't match what build_viewer would produce.
+    invalidate_page(path, page.short_name)
+
+    with profile.phase("assets"):
+        copy_and_edit_path(path, default_mask, link_assets, compress, profile)
+    profile.finish()
 
     return page_path
 
-def build_viewer(index_path="index.json", diag_name="Output Viewer", default_mask=None):
+# The FileSnapshot shared by the pages a worker process builds; each build_viewer starts new processes
+_worker_snapshot = None
+
+
+def _build_page_worker(plotspec, root_path, default_mask, column_workers, page_name, toolbar, mode, writer,
+                       profiling, output_path=None, thumbnails=None):
+    """
+    Build a single page; runs in a worker process when build_viewer is given workers.
+
+    Returns the page's profile (see BuildProfile.to_dict) if profiling, since it can't be shared with the parent.
+    """
+    global _worker_snapshot
+    if _worker_snapshot is None:
+        _worker_snapshot = FileSnapshot()
+    profile = BuildProfile() if profiling else None
+    page = Page(plotspec, root_path=root_path, permissions=default_mask, column_workers=column_workers,
+                profile=profile, writer=writer, snapshot=_worker_snapshot, output_path=output_path,
+                thumbnails=thumbnails)
+    _build(page, page_name, toolbar, mode)
+    if profile is not None:
+        return profile.to_dict()
+
+
+def _merge_profile(profile, page_profile):
+    if page_profile is not None:
+        profile.merge(page_profile)
+
+
+def staging_path(path):
+    """
+    The default directory to stage a build of the package at path in: a hidden sibling of it.
+    """
+    path = os.path.abspath(path)
+    return os.path.join(os.path.dirname(path), ".%s.staging" % os.path.basename(path))
+
+
+def _publish(stage_path, path, names):
+    """
+    Move each of names from stage_path into path, replacing what's there (see utils.move_in);
+    names that weren't staged are removed from path. stage_path is removed afterwards.
+    """
+    for name in names:
+        staged = os.path.join(stage_path, name)
+        if os.path.lexists(staged):
+            move_in(staged, os.path.join(path, name))
+        else:
+            remove_path(os.path.join(path, name))
+    remove_path(stage_path)
+
+
+def build_viewer(index_path="index.json", diag_name="Output Viewer", default_mask=None, incremental=False, workers=None,
+                 column_workers=None, link_assets=None, stream=False, mode="pages", profile=None, minify=False,
+                 compress=False, diff=False, stage=None, thumbnails=False):
     """
     Build the viewer based on the index_path.
+
+    If incremental is True, pages whose plotspec, navbar, and output_viewer version
+    are unchanged since the last build (as recorded in the build manifest) are not rebuilt.
+
+    If workers is greater than 1, pages are built in a pool of that many processes;
+    the top-level index.html is written once all of them have finished.
+
+    If column_workers is greater than 1, each page builds its column pages on that many threads.
+
+    link_assets is passed along to copy_and_edit_path.
+
+    mode "pages" writes an HTML file for every column of every row; mode "spa" writes
+    a single index.html and data.json per page and leaves the rest to viewer.js.
+    Mode "lazy" is "pages" with each group's rows in a fragment that viewer.js loads
+    when the group is opened, so pages with huge tables show up right away.
+
+    If stream is True, the index is read incrementally (see streaming.iter_index) and
+    each page is built and released before the next plotspec is read, instead of
+    loading the whole specification up front.
+
+    If profile is True, or a profiling.BuildProfile to record into, the time spent
+    in each phase of the build and on each page is recorded and the profile is
+    returned.
+
+    If minify is True, HTML is written minified. If compress is True, every page,
+    index.json, and the viewer's assets get a gzipped copy alongside them (see
+    output.OutputWriter); what each saved is recorded on the profile.
+
+    If diff is True, pages' directories aren't cleared before they're rebuilt: files that
+    come out the same are left alone, changed ones are replaced atomically, and files a
+    page no longer produces are removed. The profile counts each.
+
+    If stage is True, or the path of a directory (which could be on faster local
+    disk or tmpfs), pages and the top-level index are built in a staging directory
+    instead, and only moved into the package directory once they're all done; see
+    utils.move_in. Until then, the previous build is served as it was. True stages
+    the build in a hidden sibling of the package directory (see staging_path); if the
+    build fails, that's left behind, and cleared by the next staged build. Given a
+    directory, the build is staged in a new one inside it, which is removed whether
+    or not the build succeeds; nothing else in the given directory is touched. Staged
+    builds start from nothing, so they can't be combined with diff.
+
+    If thumbnails is True, the hover previews and page icons link to scaled-down
+    copies of the images, made in a pool of processes (workers of them, if given)
+    and cached between builds (see thumbnails.ThumbnailCache). This needs Pillow; without it, the full
+    images are used as before.
     """
-    spec = open_specs(index_path)
+    profile = _get_profile(profile)
+    if mode not in BUILD_MODES:
+        raise ValueError("Unknown build mode '%s'; expected one of %s" % (mode, ", ".join(BUILD_MODES)))
+
+    with profile.phase("load"):
+        if stream:
+            try:
+                spec = read_header(index_path)
+            except (IOError, OSError, ValueError):
+                print(("Unable to load index file at '%s'. Please make sure it's a valid JSON file." % index_path))
+                sys.exit()
+            plotspecs = profile.iterate("load", iter_plotspecs(index_path))
+        else:
+            # Not cached: a whole build reads the index once, and would keep it alive after returning
+            spec = _load_specs(index_path, cache=False)[0]
+            plotspecs = spec["specification"]
 
     if "title" in spec:
         diag_name = spec["title"]
@@ -81,21 +403,45 @@ def build_viewer(index_path="index.json", diag_name="Output Viewer", default_mas
             else:
                 menu[m["title"]] = m["url"]
 
-    spec = spec["specification"]
-
     path = os.path.dirname(index_path)
+    # Where pages and the index are written
+    out_path = path
+    stage_dir = None
+    if stage:
+        if diff:
+            raise ValueError("A staged build starts from an empty directory, so there's nothing to diff against")
+        if stage is True:
+            out_path = staging_path(path)
+            remove_path(out_path)
+            os.makedirs(out_path)
+        else:
+            # The given directory may hold other things, so only ever remove one of our own in it
+            stage_dir = stage
+            if not os.path.isdir(stage_dir):
+                os.makedirs(stage_dir)
+            out_path = tempfile.mkdtemp(prefix=".output_viewer-", dir=stage_dir)
 
-    pages = []
-    for ind, plotspec in enumerate(spec):
-        page = Page(plotspec, root_path=path, permissions=default_mask)
-        page_name = page.short_name if page.short_name else "set_%d" % (ind + 1)
-        pages.append((page, page_name))
+    thumbnail_cache = None
+    if thumbnails:
+        if thumbnails_available():
+            thumbnail_cache = ThumbnailCache(path, workers, default_mask)
+        else:
+            print("Pillow isn't installed, so previews and icons will use the full-size images.")
+
+    # Pages link to the assets by a hash of their contents, so they're out of date when the assets change
+    # As lists, since the hash sorts dict keys and the menu's order matters
+    menu_items = [(title, list(items.items()) if isinstance(items, dict) else items) for title, items in menu.items()]
+    manifest = BuildManifest(path, settings=[diag_name, menu_items, default_mask, mode, minify, compress, static_checksum(),
+                                             thumbnail_cache is not None])
+    writer = OutputWriter(minify, compress, diff)
+    # Shared by the pages built in this process; workers take their own
+    snapshot = FileSnapshot()
 
     doc = Document(diag_name)
 
     toolbar = BootstrapNavbar(diag_name, "index.html", menu)
 
-    doc.append(toolbar)
+    doc.append(toolbar.at_level(0))
     container = doc.append_tag("div", class_="container")
     row = container.append_tag("div", class_="row")
     col = row.append_tag("div", class_="col-sm-5 col-sm-offset-1")
@@ -105,20 +451,88 @@ def build_viewer(index_path="index.json", diag_name="Output Viewer", default_mas
     grid = col.append_tag('div', class_="img_links")
     table.append_header().append_cell("Output Sets")
 
-    for page, page_name in pages:
-        page.build(page_name, toolbar)
-        page_path = os.path.join(page_name, "index.html")
-        l = Link(href=page_path)
-        l.append(page.name)
-        if page.icon:
-            cell = grid.append_tag("div", class_="img_cell")
-            cell.append_tag("a", href=page_path).append_tag('img', src=page.icon)
-        table.append_row().append_cell(l)
-
-    with open(os.path.join(path, "index.html"), "w") as f:
-        toolbar.setLevel(0)
-        f.write(doc.build())
+    pool = None
+    if workers is not None and workers > 1:
+        pool = ProcessPoolExecutor(max_workers=workers)
+    pending = set()
+
+    # Only keep what the index needs, so each Page (and its rows) can be released once it's built
+    pages = []
+    # Names of the pages built this time, to publish if the build is staged
+    built = []
+    try:
+        for ind, plotspec in enumerate(plotspecs):
+            digest = spec_hash(plotspec)
+            page = Page(plotspec, root_path=path, permissions=default_mask, column_workers=column_workers,
+                        profile=profile, writer=writer, snapshot=snapshot, output_path=out_path)
+            page_name = page.short_name if page.short_name else "set_%d" % (ind + 1)
+            icon = page.icon
+            if thumbnail_cache is not None and icon:
+                with profile.phase("thumbnails"):
+                    icon = thumbnail_cache.thumbnails([icon]).get(icon, icon)
+            pages.append((page.name, icon, page_name, digest))
+            if incremental and manifest.is_current(page_name, digest, path):
+                continue
+            built.append(page_name)
+            if thumbnail_cache is not None:
+                with profile.phase("thumbnails"):
+                    page.thumbnails = thumbnail_cache.thumbnails(image_paths(plotspec))
+            if pool is None:
+                _build(page, page_name, toolbar, mode)
+                continue
+            if len(pending) >= workers * 2:
+                # Don't let queued plotspecs pile up in memory
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    # Re-raises anything that went wrong in the worker
+                    _merge_profile(profile, future.result())
+            pending.add(pool.submit(_build_page_worker, plotspec, path, default_mask, column_workers,
+                                    page_name, toolbar, mode, writer, profile is not NULL_PROFILE, out_path,
+                                    page.thumbnails))
+        for future in pending:
+            _merge_profile(profile, future.result())
+
+        for page_title, page_icon, page_name, digest in pages:
+            manifest.record(page_name, digest)
+            page_path = os.path.join(page_name, "index.html")
+            l = Link(href=page_path)
+            l.append(page_title)
+            if page_icon:
+                cell = grid.append_tag("div", class_="img_cell")
+                cell.append_tag("a", href=page_path).append_tag('img', src=page_icon)
+            table.append_row().append_cell(l)
+
+        index_html = os.path.join(out_path, "index.html")
+        writer.write_chunks(index_html, doc.iter_chunks(), profile)
+        if compress:
+            writer.compress_file(index_path, profile)
+        else:
+            # Don't leave an old build's copies for the server to send instead
+            remove_path(index_html + ".gz")
+            remove_path(index_path + ".gz")
         if default_mask is not None:
-            os.chmod(os.path.join(path, "index.html"), default_mask)
+            for written in (index_html, index_html + ".gz", index_path + ".gz"):
+                if os.path.exists(written):
+                    os.chmod(written, default_mask)
+
+        with profile.phase("assets"):
+            copy_and_edit_path(path, default_mask, link_assets, compress, profile)
+        if out_path != path:
+            with profile.phase("publish"):
+                # The index last, so it doesn't link to pages that aren't there yet
+                _publish(out_path, path, built + ["index.html", "index.html.gz"])
+    except BaseException:
+        if stage_dir is not None:
+            # Nothing else will clear it out, unlike the default staging directory
+            remove_path(out_path)
+        raise
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        if thumbnail_cache is not None:
+            thumbnail_cache.close()
+
+    manifest.save(default_mask)
 
-    copy_and_edit_path(path, default_mask)
+    if profile is not NULL_PROFILE:
+        return profile.finish()
@@ -1,5 +1,57 @@
-from xml.etree.ElementTree import TreeBuilder, tostring, XMLParser
+from xml.etree.ElementTree import TreeBuilder, tostring, XMLParser, HTML_EMPTY
+from functools import lru_cache
+from .assets import static_url
+import copy
+from sys import intern
 import os
+import re
+
+
+# String versions of what tostring(method="html") does, for markup rendered without a tree.
+def escape_text(text):
+    if "&" in text:
+        text = text.replace("&", "&amp;")
+    if "<" in text:
+        text = text.replace("<", "&lt;")
+    if ">" in text:
+        text = text.replace(">", "&gt;")
+    return text
+
+
+def escape_attr(value):
+    if "&" in value:
+        value = value.replace("&", "&amp;")
+    if ">" in value:
+        value = value.replace(">", "&gt;")
+    if '"' in value:
+        value = value.replace('"', "&quot;")
+    return value
+
+
+def start_tag(tagname, attrs=None):
+    if not attrs:
+        return "<%s>" % tagname
+    return "<%s%s>" % (tagname, "".join(' %s="%s"' % (k, escape_attr(v)) for k, v in attrs.items()))
+
+
+# Tags whose leading text isn't escaped
+RAW_TEXT = ("script", "style")
+
+# Roughly how many tags and strings iter_chunks() puts in each chunk
+CHUNK_SIZE = 2048
+
+
+def end_tag(tagname):
+    if tagname.lower() in HTML_EMPTY:
+        return ""
+    return "</%s>" % tagname
+
+
+def to_ascii(html):
+    """
+    Replace non-ASCII characters with character references, like tostring's default encoding.
+    """
+    return html.encode("ascii", "xmlcharrefreplace").decode("ascii")
 
 
 class TreeProxy(object):
@@ -32,16 +84,241 @@ class TreeProxy(object):
         return self.builder.close()
 
 
+class FragmentRecorder(object):
+    """
+    TreeBuilder target that records the calls made on it, so they can be replayed later.
+    """
+    def __init__(self):
+        self.events = []
+
+    def start(self, tagname, attrs):
+        self.events.append(("start", tagname, attrs))
+
+    def data(self, data):
+        self.events.append(("data", data))
+
+    def end(self, tagname):
+        self.events.append(("end", tagname))
+
+    def close(self):
+        return None
+
+
+# A single tag wrapped around text the parser would pass through unchanged
+SIMPLE_FRAGMENT = re.compile(r"<([A-Za-z][A-Za-z0-9_.-]*)>([^<&\r\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]*)</\1>\Z")
+
+# How many distinct append_formatted strings to keep parsed
+FRAGMENT_CACHE_SIZE = 4096
+
+
+@lru_cache(maxsize=FRAGMENT_CACHE_SIZE)
+def parse_fragment(formatted_text):
+    """
+    Parse an append_formatted string into a tuple of TreeBuilder calls (see replay_fragment).
+
+    Text that isn't well-formed comes back as it is, as a single data call. Plain text and
+    text in a single tag are handled without a parser.
+    """
+    if "<" not in formatted_text and "&" not in formatted_text:
+        # Anything but whitespace would be rejected by the parser, and end up as text anyway
+        if formatted_text.strip():
+            return (("data", formatted_text),)
+        return ()
+    match = SIMPLE_FRAGMENT.match(formatted_text)
+    if match is not None and "]]>" not in formatted_text:
+        tagname, text = match.groups()
+        if text:
+            return (("start", tagname, {}), ("data", text), ("end", tagname))
+        return (("start", tagname, {}), ("end", tagname))
+
+    recorder = FragmentRecorder()
+    try:
+        proxy = TreeProxy(recorder)
+        parser = XMLParser(target=proxy)
+        parser.feed(formatted_text)
+        proxy.cleanup()
+    except Exception as e:
+        print("Bad formatting", e)
+        # Drop whatever was parsed before the error, so there are no half-open tags
+        return (("data", str(formatted_text)),)
+    return tuple(recorder.events)
+
+
+def replay_fragment(events, root):
+    for event in events:
+        if event[0] == "start":
+            root.start(event[1], event[2])
+        elif event[0] == "data":
+            root.data(event[1])
+        else:
+            root.end(event[1])
+
+
+@lru_cache(maxsize=FRAGMENT_CACHE_SIZE)
+def render_fragment(formatted_text):
+    """
+    The HTML for an append_formatted string, outside of a script or style tag.
+    """
+    chunks = []
+    writer = HTMLWriter(chunks.append)
+    writer._open.append(["div", False])
+    replay_fragment(parse_fragment(formatted_text), writer)
+    return "".join(chunks)
+
+
+class HTMLWriter(object):
+    """
+    Drop-in for TreeBuilder that serializes straight to HTML instead of building
+    a tree, producing the same markup as tostring(method="html") on that tree
+    (before the ASCII encoding; see to_ascii).
+    """
+    def __init__(self, write):
+        self.write = write
+        # [tagname, whether the text so far is raw] for each open tag
+        self._open = []
+
+    def start(self, tagname, attrs):
+        self.start_raw()
+        self._open.append([tagname, tagname.lower() in RAW_TEXT])
+        self.write(start_tag(tagname, attrs))
+
+    def start_raw(self):
+        """
+        Mark that a child tag is about to be written (by start(), or directly with write()).
+        """
+        if self._open:
+            # Only an element's leading text is raw; anything after a child is escaped like any other
+            self._open[-1][1] = False
+
+    def data(self, data):
+        if self._open and self._open[-1][1]:
+            self.write(data)
+        else:
+            self.write(escape_text(data))
+
+    def end(self, tagname):
+        self._open.pop()
+        self.write(end_tag(tagname))
+
+    def close(self):
+        return None
+
+
+def normalize_attrs(attrs):
+    """
+    Turn keyword arguments into a flat (name, value, name, value, ...) tuple of HTML attributes:
+    "class_" becomes "class", and data={"a": 1} becomes "data-a".
+    """
+    clean_attrs = []
+    for attr, value in attrs.items():
+        attr = attr.strip("_")
+        if isinstance(value, dict):
+            for k in value:
+                clean_attrs.append(intern("%s-%s" % (attr, k)))
+                clean_attrs.append(value[k])
+        else:
+            clean_attrs.append(intern(attr))
+            clean_attrs.append(value)
+    return tuple(clean_attrs)
+
+
+class NodeIndex(object):
+    """
+    Looks up the nodes of a tree by tag name, class, or attribute; see HTMLBuilder.index().
+
+    Nodes appended anywhere in the tree after it's created are added as they come,
+    and set_attr() keeps it current. Lookups return nodes in the order they were indexed.
+    """
+    def __init__(self, root):
+        self.root = root
+        # Each maps a key to a dict used as an ordered set of nodes
+        self._tags = {}
+        self._classes = {}
+        self._attrs = {}
+        self.add(root)
+
+    def add(self, node):
+        """
+        Index node and everything under it.
+        """
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if node._index is self:
+                continue
+            node._index = self
+            self._register(node)
+            stack.extend(c for c in node.children if isinstance(c, HTMLBuilder))
+
+    def _register(self, node):
+        tagname = node.tagname()
+        if tagname is None:
+            return
+        self._tags.setdefault(tagname, {})[node] = None
+        attrs = node._attrs
+        if attrs:
+            for i in range(0, len(attrs), 2):
+                self._attrs.setdefault(attrs[i], {})[node] = None
+                if attrs[i] == "class":
+                    for name in str(attrs[i + 1]).split():
+                        self._classes.setdefault(name, {})[node] = None
+
+    def _unregister(self, node):
+        for index in (self._tags, self._classes, self._attrs):
+            for nodes in index.values():
+                nodes.pop(node, None)
+
+    def by_tag(self, tagname):
+        return list(self._tags.get(tagname, ()))
+
+    def by_class(self, name):
+        return list(self._classes.get(name, ()))
+
+    def by_attr(self, attr, value=None):
+        """
+        Nodes that have attr (normalized, like "data-preview"), and if value is given, have it set to value.
+        """
+        nodes = self._attrs.get(attr, ())
+        if value is None:
+            return list(nodes)
+        return [node for node in nodes if node.get_attr(attr) == value]
+
+
 class HTMLBuilder(object):
+    # Pages can have hundreds of thousands of nodes, so they're kept small: no __dict__,
+    # attributes normalized once up front, and None instead of empty containers.
+    __slots__ = ("_tagname", "_attrs", "_children", "_formatted", "_index")
+
     def __init__(self, tagname="div", **attrs):
-        self.children = []
-        self._formatted = []
-        # Allow things like "class_" to be normalized to "class"
-        self._attrs = attrs
+        self._children = None
+        # Indices of the children added with append_formatted
+        self._formatted = None
+        self._attrs = normalize_attrs(attrs) if attrs else None
         self._tagname = tagname
+        # The NodeIndex of the tree this node is in, if it has one
+        self._index = None
+
+    @property
+    def children(self):
+        return self._children if self._children is not None else ()
+
+    @children.setter
+    def children(self, children):
+        # Kept as given, so code that appends to it directly (self.children = []; self.children.append(...)) works
+        self._children = children
+        self._formatted = None
+        if self._index is not None:
+            for child in children or ():
+                if isinstance(child, HTMLBuilder):
+                    self._index.add(child)
 
     def append(self, child):
-        self.children.append(child)
+        if self._children is None:
+            self._children = [child]
+        else:
+            self._children.append(child)
+        if self._index is not None and isinstance(child, HTMLBuilder):
+            self._index.add(child)
 
     def append_tag(self, tagname, **attrs):
         tag = HTMLBuilder(tagname=tagname, **attrs)
@@ -49,112 +326,263 @@ class HTMLBuilder(object):
         return tag
 
     def append_formatted(self, formatted_text):
-        # We'll use an XML parser to feed the TreeBuilder when we get to this index
-        self._formatted.append(len(self.children))
-        self.children.append(formatted_text)
+        # Parsed (once per distinct string; see parse_fragment) when the tree is built
+        if self._formatted is None:
+            self._formatted = set()
+        self._formatted.add(len(self.children))
+        self.append(formatted_text)
+
+    def iter_descendants(self):
+        """
+        Yield every node under this one (not including it), in document order.
+        """
+        stack = [c for c in reversed(self.children) if isinstance(c, HTMLBuilder)]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend([c for c in reversed(node.children) if isinstance(c, HTMLBuilder)])
 
     def find(self, tagname):
-        matches = []
-        for c in self.children:
-            if isinstance(c, HTMLBuilder):
-                if c.tagname() == tagname:
-                    matches.append(c)
-                matches = matches + c.find(tagname)
-        return matches
+        return [c for c in self.iter_descendants() if c.tagname() == tagname]
+
+    def index(self):
+        """
+        Return a NodeIndex of this node and everything under it, creating it the first time.
+
+        A tree can only have one index; a node that's already in another node's index raises
+        ValueError. Appending an indexed tree to a node in another index moves it into that one.
+        """
+        if self._index is None:
+            NodeIndex(self)
+        elif self._index.root is not self:
+            raise ValueError("Node is already indexed as part of a larger tree")
+        return self._index
 
     def tagname(self):
         return self._tagname
 
     def attrs(self):
-        clean_attrs = {}
-        for attr, value in self._attrs.items():
-            attr = attr.strip("_")
-            if isinstance(value, dict):
-                for k in value:
-                    clean_attrs["%s-%s" % (attr, k)] = value[k]
-            else:
-                clean_attrs[attr] = value
-        return clean_attrs
+        attrs = self._attrs
+        if not attrs:
+            return {}
+        return dict(zip(attrs[::2], attrs[1::2]))
+
+    def get_attr(self, attr, default=None):
+        return self.attrs().get(attr, default)
+
+    def set_attr(self, attr, value):
+        attrs = self.attrs()
+        attrs[attr] = value
+        if self._index is not None:
+            self._index._unregister(self)
+        self._attrs = normalize_attrs(attrs)
+        if self._index is not None:
+            self._index._register(self)
+
+    def _start_tag(self):
+        attrs = self._attrs
+        if not attrs:
+            return "<%s>" % self.tagname()
+        return "<%s%s>" % (self.tagname(), "".join([' %s="%s"' % (attrs[i], escape_attr(attrs[i + 1]))
+                                                    for i in range(0, len(attrs), 2)]))
 
     def build(self, root=None):
+        """
+        Return this tree as HTML, or feed it to root (a TreeBuilder or HTMLWriter) if given.
+        """
         if root is None:
-            was_root = True
-            root = TreeBuilder()
-        else:
-            was_root = False
+            chunks = []
+            self._serialize(chunks)
+            return to_ascii("".join(chunks))
 
         root.start(self.tagname(), self.attrs())
         for i, child in enumerate(self.children):
             if isinstance(child, HTMLBuilder):
                 child.build(root=root)
             else:
-                if i in self._formatted:
-                    try:
-                        proxy = TreeProxy(root)
-                        parser = XMLParser(html=True, target=proxy)
-                        parser.feed(child)
-                        proxy.cleanup()
-                    except Exception as e:
-                        print("Bad formatting", e)
-                        root.data(str(child))
+                if self._formatted and i in self._formatted:
+                    replay_fragment(parse_fragment(child), root)
                 else:
                     root.data(str(child))
         root.end(self.tagname())
 
-        if was_root:
-            root = root.close()
-            return str(tostring(root, method="html").decode('utf-8'))
+    def _serialize(self, out):
+        """
+        Append this tree's HTML to the list out; a faster build() through an HTMLWriter.
+        """
+        tagname = self.tagname()
+        out.append(self._start_tag())
+        ltag = tagname.lower()
+        raw = ltag in RAW_TEXT
+        formatted = self._formatted
+        for i, child in enumerate(self._children or ()):
+            if isinstance(child, HTMLBuilder):
+                raw = False
+                child._serialize(out)
+            elif formatted and i in formatted:
+                if raw:
+                    raw = self._serialize_formatted(child, out)
+                else:
+                    out.append(render_fragment(child))
+            elif raw:
+                out.append(str(child))
+            else:
+                out.append(escape_text(str(child)))
+        if ltag not in HTML_EMPTY:
+            out.append("</%s>" % tagname)
+
+    def _serialize_formatted(self, formatted_text, out):
+        # Leading text of a script or style tag, which stays raw up to the first child tag
+        writer = HTMLWriter(out.append)
+        writer._open.append([self.tagname(), True])
+        replay_fragment(parse_fragment(formatted_text), writer)
+        return writer._open[0][1]
+
+    def _iter_serialize(self, out, chunk_size):
+        """
+        Like _serialize, but yields whenever out holds at least chunk_size pieces so the caller can flush it.
+
+        Only nodes with nested tags (and TableRows) are walked incrementally; leaves (cells, links) go
+        through _serialize.
+        """
+        tagname = self.tagname()
+        out.append(self._start_tag())
+        ltag = tagname.lower()
+        raw = ltag in RAW_TEXT
+        formatted = self._formatted
+        for i, child in enumerate(self._children or ()):
+            if isinstance(child, HTMLBuilder):
+                raw = False
+                if isinstance(child, TableRows) or any(isinstance(c, HTMLBuilder) for c in child._children or ()):
+                    for _ in child._iter_serialize(out, chunk_size):
+                        yield
+                else:
+                    child._serialize(out)
+            elif formatted and i in formatted:
+                if raw:
+                    raw = self._serialize_formatted(child, out)
+                else:
+                    out.append(render_fragment(child))
+            elif raw:
+                out.append(str(child))
+            else:
+                out.append(escape_text(str(child)))
+            if len(out) >= chunk_size:
+                yield
+        if ltag not in HTML_EMPTY:
+            out.append("</%s>" % tagname)
+
+    def iter_chunks(self, chunk_size=CHUNK_SIZE):
+        """
+        Yield this tree's HTML (the same as build()) in pieces, without holding all of it in memory.
+
+        chunk_size is roughly how many tags and strings go into each piece.
+        """
+        out = []
+        for _ in self._iter_serialize(out, chunk_size):
+            yield to_ascii("".join(out))
+            del out[:]
+        if out:
+            yield to_ascii("".join(out))
+
+    def build_to(self, fp, chunk_size=CHUNK_SIZE):
+        """
+        Write this tree's HTML to the text file fp as it's serialized; returns the number of characters written.
+        """
+        written = 0
+        for chunk in self.iter_chunks(chunk_size):
+            fp.write(chunk)
+            written += len(chunk)
+        return written
+
+
+DEFAULT_SCRIPTS = ("jquery-2.2.3.min.js", "bootstrap.min.js", "viewer.js")
+DEFAULT_STYLESHEETS = ("bootstrap.min.css", "viewer.css")
+DEFAULT_METAS = ((("name", "viewport"), ("content", "width=device-width, intial-scale=1")), (("charset", "utf-8"),))
+
+
+@lru_cache(maxsize=None)
+def viewer_assets(level):
+    """
+    The (scripts, stylesheets) every Document links to, relative to a page nested level directories deep.
+
+    They're linked by their fingerprinted names; see assets.static_fingerprints.
+    """
+    prefix = os.path.join(*([".."] * level + ["viewer"]))
+    scripts = tuple(os.path.join(prefix, static_url("js/" + script)) for script in DEFAULT_SCRIPTS)
+    stylesheets = tuple(os.path.join(prefix, static_url("css/" + sheet)) for sheet in DEFAULT_STYLESHEETS)
+    return scripts, stylesheets
+
+
+@lru_cache(maxsize=64)
+def render_head_assets(scripts, stylesheets, metas):
+    """
+    The <meta>, <link> and <script> tags of a Document's head; metas are tuples of (name, value) pairs.
+    """
+    chunks = []
+    root = HTMLWriter(chunks.append)
+    for meta in metas:
+        root.start("meta", dict(meta))
+        root.end("meta")
+    for style in stylesheets:
+        root.start("link", {"rel": "stylesheet", "href": style, "type": "text/css"})
+        root.end("link")
+    for script in scripts:
+        root.start("script", {"type": "text/javascript", "src": script})
+        root.data(" ")
+        root.end('script')
+    return "".join(chunks)
 
 
 class Document(HTMLBuilder):
+    # Scripts, stylesheets and metas are tuples, shared between Documents until they're added to
+    __slots__ = ("_scripts", "_stylesheets", "_metas", "title")
+
     def __init__(self, title=None, level=0):
         # Adjust for nesting level
-        self._scripts = []
-        for script in ["jquery-2.2.3.min.js", "bootstrap.min.js", "viewer.js"]:
-            self._scripts.append(os.path.join(*([".."] * level + ["viewer", "js", script])))
-
-        self._stylesheets = []
-        for sheet in ["bootstrap.min.css", "viewer.css"]:
-            self._stylesheets.append(os.path.join(*([".."] * level + ["viewer", "css", sheet])))
-
-        self._metas = [{"name": "viewport", "content": "width=device-width, intial-scale=1"}, {"charset": "utf-8"}]
-        self.children = []
-        self._formatted = []
-        self._attrs = {}
+        self._scripts, self._stylesheets = viewer_assets(level)
+        self._metas = DEFAULT_METAS
+        self._children = None
+        self._formatted = None
+        self._attrs = None
+        self._tagname = "body"
+        self._index = None
         self.title = title
 
     def tagname(self):
         return "body"
 
     def append_script(self, path):
-        self._scripts.append(path)
+        self._scripts += (path,)
 
     def append_style(self, path):
-        self._stylesheets.append(path)
+        self._stylesheets += (path,)
 
     def append_meta(self, attrs):
-        self._metas.append(attrs)
+        self._metas += (tuple(attrs.items()),)
+
+    def head_assets(self):
+        """
+        The markup for everything in the head but the title; rendered once for each combination of assets.
+        """
+        return render_head_assets(self._scripts, self._stylesheets, self._metas)
+
+    def _head(self):
+        if self.title:
+            return "<head><title>%s</title>%s</head>" % (escape_text(self.title), self.head_assets())
+        return "<head>%s</head>" % self.head_assets()
+
+    def iter_chunks(self, chunk_size=CHUNK_SIZE):
+        yield to_ascii("<!DOCTYPE html>\n<html>%s" % self._head())
+        for chunk in super(Document, self).iter_chunks(chunk_size):
+            yield chunk
+        yield "</html>"
 
     def build(self, root=None):
         if root is None:
-            root = TreeBuilder()
-            root.start("html", {})
-            root.start("head", {})
-            if self.title:
-                root.start("title", {})
-                root.data(self.title)
-                root.end("title")
-            for meta in self._metas:
-                root.start("meta", meta)
-                root.end("meta")
-            for style in self._stylesheets:
-                root.start("link", {"rel": "stylesheet", "href": style, "type": "text/css"})
-                root.end("link")
-            for script in self._scripts:
-                root.start("script", {"type": "text/javascript", "src": script})
-                root.data(" ")
-                root.end('script')
-            root.end("head")
+            body = []
+            self._serialize(body)
+            return "<!DOCTYPE html>\n%s" % to_ascii("<html>%s%s</html>" % (self._head(), "".join(body)))
         super(Document, self).build(root=root)
         root.end("html")
         root = root.close()
@@ -162,16 +590,22 @@ class Document(HTMLBuilder):
 
 
 class TableCell(HTMLBuilder):
+    __slots__ = ()
+
     def tagname(self):
         return 'td'
 
 
 class TableHeader(HTMLBuilder):
+    __slots__ = ()
+
     def tagname(self):
         return "th"
 
 
 class TableRow(HTMLBuilder):
+    __slots__ = ()
+
     def tagname(self):
         return "tr"
 
@@ -182,6 +616,8 @@ class TableRow(HTMLBuilder):
 
 
 class HeaderRow(TableRow):
+    __slots__ = ()
+
     def append_cell(self, child, **attrs):
         cell = TableHeader(**attrs)
         cell.append(child)
@@ -189,6 +625,8 @@ class HeaderRow(TableRow):
 
 
 class Table(HTMLBuilder):
+    __slots__ = ()
+
     def tagname(self):
         return "table"
 
@@ -202,18 +640,141 @@ class Table(HTMLBuilder):
         self.append(row)
         return row
 
+    def append_rows(self, rows, colspans, **attrs):
+        """
+        Add many rows at once without building a node per row and cell; see TableRows.
+        """
+        block = TableRows(rows, colspans, **attrs)
+        self.append(block)
+        return block
+
+
+class TableRows(HTMLBuilder):
+    """
+    A run of table rows kept as plain tuples and rendered straight to HTML, for tables too
+    big to build a TableRow, TableCell and Link for every cell.
+
+    Each row is (title, cells): title is markup for the first cell (as for append_formatted),
+    and cells holds one entry per column, either a value shown as text or a
+    (tagname, attrs, text) tuple for an element wrapping the text, with attrs a dict or None.
+    Cell i spans colspans[i] columns; cells past the end of colspans are left out.
+
+    Renders the same as append_row(**attrs) with append_cell(..., colspan=colspans[i]) for each
+    cell. Neither the rows nor the block itself are tags (it has no tagname, like RawHTML),
+    so find() and index() don't see them.
+    """
+    __slots__ = ("rows", "colspans")
+
+    def __init__(self, rows, colspans, **attrs):
+        # attrs are each row's, not a tag of the block's own
+        super(TableRows, self).__init__(tagname=None, **attrs)
+        self.rows = list(rows)
+        self.colspans = [str(c) for c in colspans]
+
+    def append(self, child):
+        raise TypeError("TableRows can't have children")
+
+    def build(self, root=None):
+        if root is None or isinstance(root, HTMLWriter):
+            chunks = []
+            self._serialize(chunks)
+            if root is None:
+                return to_ascii("".join(chunks))
+            root.start_raw()
+            root.write("".join(chunks))
+            return
+        attrs = self.attrs()
+        for title, cells in self.rows:
+            root.start("tr", attrs)
+            root.start("td", {})
+            replay_fragment(parse_fragment(title), root)
+            root.end("td")
+            for colspan, cell in zip(self.colspans, cells):
+                root.start("td", {"colspan": colspan})
+                if isinstance(cell, tuple):
+                    tagname, cell_attrs, text = cell
+                    root.start(tagname, cell_attrs or {})
+                    root.data(str(text))
+                    root.end(tagname)
+                else:
+                    root.data(str(cell))
+                root.end("td")
+            root.end("tr")
+
+    def _serialize(self, out):
+        for _ in self._iter_serialize(out, None):
+            pass
+
+    def _iter_serialize(self, out, chunk_size):
+        row_tag = start_tag("tr", self.attrs())
+        cell_tags = ['<td colspan="%s">' % escape_attr(c) for c in self.colspans]
+        append = out.append
+        for title, cells in self.rows:
+            append(row_tag)
+            append("<td>")
+            append(render_fragment(title))
+            append("</td>")
+            for cell_tag, cell in zip(cell_tags, cells):
+                append(cell_tag)
+                if isinstance(cell, tuple):
+                    tagname, cell_attrs, text = cell
+                    append(start_tag(tagname, cell_attrs))
+                    append(escape_text(str(text)))
+                    append("</%s>" % tagname)
+                else:
+                    append(escape_text(str(cell)))
+                append("</td>")
+            append("</tr>")
+            if chunk_size is not None and len(out) >= chunk_size:
+                yield
+
 
 class Link(HTMLBuilder):
+    __slots__ = ()
+
     def tagname(self):
         return "a"
 
 
 class Span(HTMLBuilder):
+    __slots__ = ()
+
     def tagname(self):
         return "span"
 
 
+class RawHTML(HTMLBuilder):
+    """
+    Markup that's already been rendered, to splice into a tree as it is. It can't be changed or have children.
+    """
+    __slots__ = ("html",)
+
+    def __init__(self, html):
+        super(RawHTML, self).__init__(tagname=None)
+        self.html = html
+
+    def append(self, child):
+        raise TypeError("RawHTML can't have children")
+
+    def set_attr(self, attr, value):
+        raise TypeError("RawHTML can't be changed")
+
+    def build(self, root=None):
+        if root is None:
+            return to_ascii(self.html)
+        if isinstance(root, HTMLWriter):
+            root.start_raw()
+            root.write(self.html)
+        else:
+            replay_fragment(parse_fragment(self.html), root)
+
+    def _serialize(self, out):
+        out.append(self.html)
+
+
 class BootstrapDropdown(HTMLBuilder):
+    __slots__ = ()
+
     def __init__(self, name, links):
         super(BootstrapDropdown, self).__init__(class_="dropdown")
         outer_link = self.append_tag("a", href="#", class_="dropdown-toggle", data={"toggle": "dropdown"}, aria={"haspopup":"true", "expanded": "false"}, role="button")
@@ -232,9 +793,13 @@ class BootstrapDropdown(HTMLBuilder):
 
 
 class BootstrapNavbar(HTMLBuilder):
+    # RawHTML for each level at_level() has rendered
+    __slots__ = ("_levels",)
+
     def __init__(self, brand, root, links, **attrs):
         attrs.update({"class_": "navbar navbar-default"})
         super(BootstrapNavbar, self).__init__(**attrs)
+        self._levels = {}
         container = self.append_tag("div", class_="container-fluid")
         brand_link = container.append_tag("a", class_="navbar-brand", href=root)
         brand_link.append(brand)
@@ -259,9 +824,10 @@ class BootstrapNavbar(HTMLBuilder):
     def setLevel(self, level):
         links = self.find("a")
         for l in links:
-            if "href" in l._attrs and l._attrs["href"][0] != "/":
+            href = l.get_attr("href")
+            if href is not None and href[0] != "/":
                 # Remove all leading "../"
-                parts = l._attrs["href"].split("/")
+                parts = href.split("/")
                 filtered = []
                 for p in parts:
                     # Only remove the leading ones...
@@ -269,7 +835,25 @@ class BootstrapNavbar(HTMLBuilder):
                         continue
                     filtered.append(p)
 
-                l._attrs["href"] = os.path.join(*([".."] * level + filtered))
+                l.set_attr("href", os.path.join(*([".."] * level + filtered)))
+        self._levels = {}
+
+    def at_level(self, level):
+        """
+        The navbar as it would be after setLevel(level), as a RawHTML to append to a page.
+
+        Each level is rendered once and then shared, so unlike setLevel() this doesn't
+        change the navbar, and is safe to use from several threads.
+        """
+        rendered = self._levels.get(level)
+        if rendered is None:
+            navbar = copy.deepcopy(self)
+            navbar.setLevel(level)
+            chunks = []
+            navbar._serialize(chunks)
+            rendered = RawHTML("".join(chunks))
+            self._levels[level] = rendered
+        return rendered
 
     def tagname(self):
         return "nav"
@@ -0,0 +1,94 @@
+import hashlib
+import json
+import os
+import stat
+import threading
+from . import __version__
+
+
+MANIFEST_NAME = ".output_viewer_manifest.json"
+
+
+def spec_hash(*objs):
+    """
+    Stable hash of any JSON-serializable objects.
+    """
+    digest = hashlib.sha1()
+    for obj in objs:
+        digest.update(json.dumps(obj, sort_keys=True, separators=(",", ":")).encode("utf-8"))
+    return digest.hexdigest()
+
+
+class BuildManifest(object):
+    """
+    Records what every page of a built viewer was rendered from, so a later
+    build can skip the pages whose inputs haven't changed.
+
+    A page is considered current when its plotspec, the navbar (title and menu),
+    and the output_viewer version all match what was recorded when it was last
+    built. Output files that appear or disappear on disk without the index
+    changing are not detected; do a full build to pick those up.
+    """
+    def __init__(self, root_path, settings=None):
+        self.path = os.path.join(root_path, MANIFEST_NAME)
+        self.settings = spec_hash(__version__, settings)
+        self.pages = {}
+        self._previous = {}
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path) as manifest_file:
+                manifest = json.load(manifest_file)
+        except (IOError, OSError, ValueError):
+            return
+        if manifest.get("settings") != self.settings:
+            # Version or navbar changed; every page is stale.
+            return
+        self._previous = manifest.get("pages", {})
+
+    def is_current(self, page_name, digest, root_path):
+        """
+        Check if page_name was last built from a plotspec hashing to digest (see spec_hash).
+        """
+        if self._previous.get(page_name) != digest:
+            return False
+        return os.path.exists(os.path.join(root_path, page_name, "index.html"))
+
+    def record(self, page_name, digest):
+        self.pages[page_name] = digest
+
+    def save(self, default_mask=None):
+        _write_manifest(self.path, {"settings": self.settings, "pages": self.pages}, default_mask)
+
+
+def _write_manifest(path, manifest, mode=None):
+    """
+    Write manifest to path through a temporary file that replaces it, so readers
+    (like a concurrent invalidate_page) never see it half-written.
+    """
+    tmp_path = "%s.tmp-%d-%d" % (path, os.getpid(), threading.get_ident())
+    try:
+        with open(tmp_path, "w") as manifest_file:
+            json.dump(manifest, manifest_file)
+        if mode is not None:
+            os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def invalidate_page(root_path, page_name):
+    """
+    Drop a page from the manifest at root_path, forcing the next incremental build to rebuild it.
+    """
+    path = os.path.join(root_path, MANIFEST_NAME)
+    try:
+        with open(path) as manifest_file:
+            manifest = json.load(manifest_file)
+            mode = stat.S_IMODE(os.fstat(manifest_file.fileno()).st_mode)
+    except (IOError, OSError, ValueError):
+        return
+    if manifest.get("pages", {}).pop(page_name, None) is not None:
+        _write_manifest(path, manifest, mode)
@@ -0,0 +1,329 @@
+import filecmp
+import gzip
+import os
+import re
+import threading
+from .profiling import NULL_PROFILE
+from .utils import write_chunks, write_file, nuke_and_pave, remove_path
+
+
+# Elements whose contents are passed through untouched
+PRESERVED = ("script", "style", "pre", "textarea")
+# End tags HTML lets you leave out when the element is followed by a sibling or the end of its parent,
+# which is always the case in what the builders generate
+OPTIONAL_END_TAGS = ("</td>", "</th>", "</tr>", "</li>", "</option>")
+DEFAULT_TYPES = {"script": ' type="text/javascript"', "link": ' type="text/css"', "style": ' type="text/css"'}
+QUOTED_ATTR = re.compile(r' ([^\s="]+)="([^"]*)"')
+UNQUOTED_VALUE = re.compile(r"[^\s\"'=<>`]+\Z")
+WHITESPACE = re.compile(r"[ \t\n\r\f]+")
+
+# Files in the viewer's static assets worth precompressing
+COMPRESSIBLE = (".html", ".json", ".js", ".css", ".svg", ".map", ".txt", ".eot", ".ttf")
+
+
+class HTMLMinifier(object):
+    """
+    Minifies HTML fed to it a chunk at a time: collapses whitespace, drops optional end tags and
+    default type attributes, and unquotes attribute values that don't need quotes. The document
+    parses to the same DOM.
+
+    bytes_in and bytes_out count what went in and came out.
+    """
+    def __init__(self):
+        self._pending = ""
+        # End tag of the preserved element we're inside, if any
+        self._preserve = None
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def feed(self, chunk):
+        self.bytes_in += len(chunk)
+        data = self._pending + chunk
+        out = []
+        pos = 0
+        while pos < len(data):
+            if self._preserve is not None:
+                end = data.lower().find(self._preserve, pos)
+                if end == -1:
+                    # Hold back enough to find the end tag if it's split across chunks
+                    keep = max(pos, len(data) - len(self._preserve))
+                    out.append(data[pos:keep])
+                    pos = keep
+                    break
+                out.append(data[pos:end])
+                pos = end
+                self._preserve = None
+            elif data[pos] == "<":
+                end = data.find(">", pos)
+                if end == -1:
+                    break
+                out.append(self._tag(data[pos:end + 1]))
+                pos = end + 1
+            else:
+                end = data.find("<", pos)
+                if end == -1:
+                    # The text might go on in the next chunk
+                    break
+                out.append(WHITESPACE.sub(" ", data[pos:end]))
+                pos = end
+        self._pending = data[pos:]
+        html = "".join(out)
+        self.bytes_out += len(html)
+        return html
+
+    def close(self):
+        rest, self._pending = self._pending, ""
+        if self._preserve is None and not rest.startswith("<"):
+            rest = WHITESPACE.sub(" ", rest)
+        self.bytes_out += len(rest)
+        return rest
+
+    def minify(self, chunks):
+        for chunk in chunks:
+            yield self.feed(chunk)
+        yield self.close()
+
+    def _tag(self, tag):
+        if tag in OPTIONAL_END_TAGS:
+            return ""
+        if tag.startswith("</") or tag.startswith("<!"):
+            return tag
+        name = tag[1:-1].split(None, 1)[0].rstrip("/").lower() if len(tag) > 2 else ""
+        if name in PRESERVED:
+            self._preserve = "</" + name
+        if name in DEFAULT_TYPES:
+            tag = tag.replace(DEFAULT_TYPES[name], "")
+        return QUOTED_ATTR.sub(_unquote, tag)
+
+
+def _unquote(match):
+    if UNQUOTED_VALUE.match(match.group(2)):
+        return " %s=%s" % (match.group(1), match.group(2))
+    return match.group(0)
+
+
+class OutputWriter(object):
+    """
+    Writes the files of a build.
+
+    With minify, HTML files are minified (see HTMLMinifier) as they're written. With compress,
+    each file also gets a gzipped copy next to it (index.html.gz), compressed from the same
+    stream, for servers that can send precompressed files (like nginx's gzip_static). A .gz
+    that wouldn't be smaller than the file isn't kept.
+
+    With diff, the output directories aren't cleared (see prepare_dir): a file that already
+    holds what would be written is left alone, a changed one is written to a temporary file
+    that's renamed over it, and sweep() removes the files a page no longer produces.
+
+    What minifying and compressing saved, and how many files diff left alone or removed,
+    is recorded on the profile; see BuildProfile.
+    """
+    def __init__(self, minify=False, compress=False, diff=False):
+        self.minify = minify
+        self.compress = compress
+        self.diff = diff
+        # Absolute paths of the files and directories produced since the last sweep(), with diff
+        self._produced = set()
+
+    def prepare_dir(self, path):
+        """
+        Get the directory at path ready for a fresh set of files: emptied, or with diff,
+        created if it's missing and otherwise left for sweep() to tidy up.
+        """
+        if not self.diff:
+            nuke_and_pave(path)
+            return
+        if not os.path.isdir(path):
+            remove_path(path)
+            os.makedirs(path)
+        self._produced.add(os.path.abspath(path))
+
+    def sweep(self, path, profile=NULL_PROFILE):
+        """
+        With diff, remove everything under path that wasn't produced since the last sweep.
+        """
+        if not self.diff:
+            return
+        root = os.path.abspath(path)
+        produced = self._produced
+        for dirpath, dirs, files in os.walk(root, topdown=False):
+            for f in files:
+                full_path = os.path.join(dirpath, f)
+                if full_path not in produced:
+                    os.remove(full_path)
+                    profile.removed()
+            if dirpath != root and dirpath not in produced and not os.listdir(dirpath):
+                os.rmdir(dirpath)
+        prefix = root + os.sep
+        self._produced = set(p for p in produced if p != root and not p.startswith(prefix))
+
+    def write_file(self, path, content, profile=NULL_PROFILE):
+        if not self.minify and not self.compress and not self.diff:
+            write_file(path, content, profile)
+        else:
+            self.write_chunks(path, (content,), profile)
+
+    def write_chunks(self, path, chunks, profile=NULL_PROFILE):
+        if not self.minify and not self.compress and not self.diff:
+            write_chunks(path, chunks, profile)
+            return
+        chunks = profile.iterate("serialize", chunks)
+        minifier = None
+        if self.minify and path.endswith(".html"):
+            minifier = HTMLMinifier()
+            chunks = minifier.minify(chunks)
+
+        if self.diff:
+            self._update(path, chunks, profile)
+        else:
+            written = 0
+            with open(path, "w") as out:
+                compressor = _Compressor(path, profile) if self.compress else None
+                try:
+                    for chunk in chunks:
+                        with profile.phase("write"):
+                            out.write(chunk)
+                            if compressor is not None:
+                                compressor.write(chunk.encode("utf-8"))
+                        written += len(chunk)
+                finally:
+                    if compressor is not None:
+                        compressor.close(written)
+            profile.wrote(written)
+        if minifier is not None:
+            profile.minified(minifier.bytes_in - minifier.bytes_out)
+
+    def _update(self, path, chunks, profile):
+        """
+        Write chunks to path unless it already holds exactly that, compressing it too if need be.
+
+        The new content is compared with the file as it's produced, so neither is held in memory;
+        the part that matched is copied over from the old file if they turn out to differ.
+        """
+        self._produced.add(os.path.abspath(path))
+        try:
+            existing = open(path, "rb")
+        except (IOError, OSError):
+            existing = None
+        out = None
+        tmp_path = "%s.tmp-%d-%d" % (path, os.getpid(), threading.get_ident())
+        matched = written = 0
+        try:
+            for chunk in chunks:
+                data = chunk.encode("utf-8")
+                written += len(chunk)
+                with profile.phase("write"):
+                    if out is None and existing is not None:
+                        if existing.read(len(data)) == data:
+                            matched += len(data)
+                            continue
+                    if out is None:
+                        out = _start_from(tmp_path, existing, matched)
+                    out.write(data)
+            with profile.phase("write"):
+                if out is None and existing is not None and not existing.read(1):
+                    unchanged = True
+                else:
+                    unchanged = False
+                    if out is None:
+                        # The old file was longer
+                        out = _start_from(tmp_path, existing, matched)
+                    out.close()
+                    os.replace(tmp_path, path)
+        except BaseException:
+            if out is not None:
+                out.close()
+                remove_path(tmp_path)
+            raise
+        finally:
+            if existing is not None:
+                existing.close()
+
+        if unchanged:
+            profile.unchanged()
+        else:
+            profile.wrote(written)
+        if self.compress:
+            if unchanged and os.path.exists(path + ".gz"):
+                self._produced.add(os.path.abspath(path + ".gz"))
+                profile.unchanged()
+            else:
+                self.compress_file(path, profile)
+
+    def compress_file(self, path, profile=NULL_PROFILE):
+        """
+        Write a gzipped copy of the existing file at path next to it.
+        """
+        size = 0
+        compressor = _Compressor(path, profile, keep_same=self.diff)
+        try:
+            with open(path, "rb") as source:
+                for block in iter(lambda: source.read(1 << 16), b""):
+                    compressor.write(block)
+                    size += len(block)
+        finally:
+            if compressor.close(size) and self.diff:
+                self._produced.add(os.path.abspath(compressor.path))
+
+    def compress_tree(self, path, profile=NULL_PROFILE):
+        """
+        Write gzipped copies of the compressible files under path.
+        """
+        for dirpath, _, files in os.walk(path):
+            for f in files:
+                if os.path.splitext(f)[1] in COMPRESSIBLE:
+                    self.compress_file(os.path.join(dirpath, f), profile)
+
+
+def _start_from(tmp_path, existing, length):
+    """
+    Open tmp_path for writing, starting it with the first length bytes of the file existing.
+    """
+    out = open(tmp_path, "wb")
+    if length:
+        existing.seek(0)
+        while length:
+            block = existing.read(min(length, 1 << 16))
+            out.write(block)
+            length -= len(block)
+    return out
+
+
+class _Compressor(object):
+    """
+    Streams bytes into path + ".gz", through a temporary file that replaces it on close().
+    close() discards it, and returns False, if it didn't come out smaller than original_size.
+    With keep_same, a .gz that already has the same content is left alone.
+    """
+    def __init__(self, path, profile, keep_same=False):
+        self.path = path + ".gz"
+        self.profile = profile
+        self.keep_same = keep_same
+        self._tmp_path = "%s.tmp-%d-%d" % (self.path, os.getpid(), threading.get_ident())
+        self._file = open(self._tmp_path, "wb")
+        # No name or timestamp in the header, so identical content compresses identically
+        self._gzip = gzip.GzipFile(filename="", mode="wb", fileobj=self._file, mtime=0)
+
+    def write(self, data):
+        self._gzip.write(data)
+
+    def close(self, original_size):
+        self._gzip.close()
+        size = self._file.tell()
+        self._file.close()
+        if size >= original_size:
+            os.remove(self._tmp_path)
+            # An old copy would no longer match
+            remove_path(self.path)
+            return False
+        if self.keep_same and os.path.isfile(self.path) and filecmp.cmp(self._tmp_path, self.path, shallow=False):
+            os.remove(self._tmp_path)
+            self.profile.unchanged()
+            return True
+        os.replace(self._tmp_path, self.path)
+        self.profile.wrote(size)
+        self.profile.compressed(original_size, size)
+        return True
+
+
+PLAIN_WRITER = OutputWriter()
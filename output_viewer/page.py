@@ -1,7 +1,11 @@
-from .htmlbuilder import Document, Table, TableCell, Link, Span, HTMLBuilder
+from .htmlbuilder import Document, Table, TableRows, Link, Span, HTMLBuilder
+from .htmlbuilder import escape_text, escape_attr, start_tag, to_ascii
+import json
 import os
 from .examine import is_img, is_data
-from .utils import slugify, nuke_and_pave, rechmod
+from .utils import slugify, rechmod, BoundedThreadPool, FileSnapshot
+from .profiling import NULL_PROFILE
+from .output import PLAIN_WRITER
 
 
 file_extensions = {
@@ -12,6 +16,17 @@ file_extensions = {
 }
 
 
+class BuildError(RuntimeError):
+    """
+    Raised when some of a page's files couldn't be built; failures is a list of (path, exception).
+    """
+    def __init__(self, failures):
+        self.failures = failures
+        lines = ["%s: %s" % (path, error) for path, error in failures]
+        msg = "Failed to build %d file(s):\n%s" % (len(failures), "\n".join(lines))
+        super(BuildError, self).__init__(msg)
+
+
 class Column(object):
     def __init__(self, row, spec):
         self.row = row
@@ -21,26 +36,50 @@ class Column(object):
             self.title = os.path.basename(os.path.splitext(self.path)[0])
         self.meta = spec.get("meta", {})
         self.files = spec.get("files", [])
+        # Neighbouring columns in the row; filled in by Row
+        self.prev = None
+        self.next = None
+        self._exists = None
+
+    def getDownloads(self, level=3):
+        """
+        List of (url, title) for the files offered for download, starting with the one shown.
+
+        URLs are relative to a page level directories below the root; column pages are at level 3.
+        """
+        downloads = []
+        all_files = [{"title": "File Shown", "url": self.path}] + self.files
+        for f in all_files:
+            # Root/Page/Group/Row/this.html
+            file_url = os.path.join(*([".."] * level + [f["url"]]))
+            t = f.get("title")
+            if t is None:
+                _, t = os.path.splitext(f["url"])
+                if t in file_extensions:
+                    t = file_extensions[t]
+                else:
+                    t += " File"
+            downloads.append((file_url, t))
+        return downloads
 
-    def build(self, toolbar):
+    def document(self, toolbar):
+        """
+        Build the Document for this column's page; see ColumnTemplate for the fast path.
+        """
         doc = Document(title=self.title, level=3)
         if toolbar is not None:
-            doc.append(toolbar)
-
-        for col_ind, col in self.row.cols.items():
-            if col == self:
-                break
+            doc.append(toolbar.at_level(3))
 
         container = doc.append_tag("div", class_="container")
         row = container.append_tag("div", class_="row")
 
-        if col_ind > min(self.row.cols.keys()):
-            back = doc.append_tag("form", action=self.row.cols[col_ind - 1].getFileName(), class_="col_link back")
+        if self.prev is not None:
+            back = doc.append_tag("form", action=self.prev.getFileName(), class_="col_link back")
             link_back = back.append_tag("button", type="submit", data={"arrow": "left"})
             link_back.append("<")
 
-        if col_ind < max(self.row.cols.keys()):
-            n = doc.append_tag("form", action=self.row.cols[col_ind + 1].getFileName(), class_="col_link next")
+        if self.next is not None:
+            n = doc.append_tag("form", action=self.next.getFileName(), class_="col_link next")
             link_next = n.append_tag("button", type="submit", data={"arrow": "right"})
             link_next.append(">")
 
@@ -55,26 +94,15 @@ class Column(object):
         if is_img(self.path):
             file_div.append_tag("img", src=file_url)
 
-        all_files = [{"title": "File Shown", "url": self.path}] + self.files
-
         file_downloads = file_div.append_tag("div")
         file_downloads.append_tag("label").append("Files:")
         s = file_downloads.append_tag("select", class_="form-control download_urls")
         download_link = file_downloads.append_tag("a", class_="btn btn-primary download_link", download="")
         download_link.append("Download")
-        for i, f in enumerate(all_files):
-            # Root/Page/Group/Row/this.html
-            file_url = os.path.join("..", "..", "..", f["url"])
+        for i, (file_url, t) in enumerate(self.getDownloads()):
             if i == 0:
-                download_link._attrs["href"] = file_url
+                download_link.set_attr("href", file_url)
             option = s.append_tag("option", value=file_url)
-            t = f.get("title")
-            if t is None:
-                _, t = os.path.splitext(f["url"])
-                if t in file_extensions:
-                    t = file_extensions[t]
-                else:
-                    t += " File"
             option.append(t)
 
         disclose_div = container.append_tag("div", class_="disclosable row", data={"title": "Output Metadata"})
@@ -88,28 +116,118 @@ class Column(object):
             r.append_cell(v)
 
         disclose_div.append(table)
-
-        html_path = os.path.join(self.row.group.dirpath, self.row.title, slugify(self.title) + ".html")
-        with open(html_path, "w") as out:
-            if toolbar is not None:
-                toolbar.setLevel(3)
-            out.write(doc.build())
+        return doc
+
+    def build(self, toolbar, template=None):
+        profile, writer = self.row.group.profile, self.row.group.writer
+        if template is None:
+            with profile.phase("tree"):
+                doc = self.document(toolbar)
+            writer.write_chunks(self.getFilePath(), doc.iter_chunks(), profile)
+        else:
+            with profile.phase("serialize"):
+                html = template.render(self)
+            writer.write_file(self.getFilePath(), html, profile)
 
     def getFileName(self):
         return slugify(self.title) + ".html"
 
+    def getFilePath(self):
+        return os.path.join(self.row.group.dirpath, self.row.title, self.getFileName())
+
     def getURL(self):
         return os.path.join(self.row.dirname, self.getFileName())
 
+    def exists(self):
+        if self._exists is None:
+            self._exists = self.row.group.snapshot.exists(os.path.join(self.row.group.source_root, self.path))
+        return self._exists
+
+    def getPreview(self, level):
+        """
+        URL of the image to preview this column with (its thumbnail, if it has one), relative to a page at level.
+        """
+        return os.path.join(*([".."] * level + [self.row.group.thumbnails.get(self.path, self.path)]))
+
+    def toDict(self, level=1):
+        """
+        Everything needed to render this column client-side, with URLs relative to a page at level.
+        """
+        return {
+            "title": self.title,
+            "url": self.getURL(),
+            "path": os.path.join(*([".."] * level + [self.path])),
+            "preview": self.getPreview(level),
+            "image": is_img(self.path),
+            "exists": self.exists(),
+            "meta": self.meta,
+            "files": self.getDownloads(level),
+        }
+
     def getLink(self, level):
-        path = os.path.join(os.path.dirname(os.path.dirname(self.row.group.dirpath)), self.path)
-        if os.path.exists(path):
-            l = Link(href=self.getURL(), data={"preview": os.path.join(*([".."] * level + [self.path]))})
+        if self.exists():
+            l = Link(href=self.getURL(), data={"preview": self.getPreview(level)})
         else:
             l = Span()
         l.append(self.title)
         return l
 
+    def getCell(self, level):
+        """
+        getLink(level) as a (tagname, attrs, text) cell for Table.append_rows.
+        """
+        if self.exists():
+            return ("a", {"href": self.getURL(), "data-preview": self.getPreview(level)}, self.title)
+        return ("span", None, self.title)
+
+
+class ColumnTemplate(object):
+    """
+    Renders column pages straight to strings, with the markup every column
+    shares (head, navbar) rendered once up front. The result is the same as
+    building Column.document().
+    """
+    def __init__(self, toolbar=None):
+        head = [Document(level=3).head_assets(), "</head><body>"]
+        if toolbar is not None:
+            head.append(toolbar.at_level(3).html)
+        head.append('<div class="container"><div class="row"><h1 class="img_title">')
+        self._head = "".join(head)
+
+    def render(self, column):
+        title = escape_text(str(column.title))
+        parts = ["<!DOCTYPE html>\n<html><head>"]
+        if column.title:
+            parts.append("<title>%s</title>" % title)
+        parts.append(self._head)
+        parts.append(title)
+        parts.append('</h1></div><div class="row"><div class="col-sm-12"><div class="img_display">')
+
+        downloads = column.getDownloads()
+        if is_img(column.path):
+            parts.append(start_tag("img", {"src": os.path.join("..", "..", "..", column.path)}))
+        parts.append('<div><label>Files:</label><select class="form-control download_urls">')
+        for file_url, t in downloads:
+            parts.append('<option value="%s">%s</option>' % (escape_attr(file_url), escape_text(str(t))))
+        parts.append('</select><a class="btn btn-primary download_link" download="" href="%s">Download</a>'
+                     % escape_attr(downloads[0][0]))
+
+        parts.append('</div></div></div></div><div class="disclosable row" data-title="Output Metadata">'
+                     '<table class="table"><tr><th style="min-width: 15%;">Metadata Key</th>'
+                     '<th>Metadata Value</th></tr>')
+        for k, v in column.meta.items():
+            parts.append("<tr><td>%s</td><td>%s</td></tr>" % (escape_text(str(k)), escape_text(str(v))))
+        parts.append("</table></div></div>")
+
+        if column.prev is not None:
+            parts.append('<form action="%s" class="col_link back"><button type="submit" data-arrow="left">'
+                         '&lt;</button></form>' % escape_attr(column.prev.getFileName()))
+        if column.next is not None:
+            parts.append('<form action="%s" class="col_link next"><button type="submit" data-arrow="right">'
+                         '&gt;</button></form>' % escape_attr(column.next.getFileName()))
+        parts.append("</body></html>")
+        return to_ascii("".join(parts))
+
 
 class Row(object):
     def __init__(self, group, spec):
@@ -123,6 +241,15 @@ class Row(object):
                 # We don't actually need to keep track of the "string" columns
                 # They'll just be plain text
                 continue
+        # Columns whose file is missing don't get a page, so they're left out of the back/next links
+        prev = None
+        for col in self.cols.values():
+            if not col.exists():
+                continue
+            col.prev = prev
+            if prev is not None:
+                prev.next = col
+            prev = col
         self.dirname = os.path.join(self.group.dirname, self.title)
 
     def getLink(self, col_ind, level):
@@ -131,16 +258,31 @@ class Row(object):
         else:
             return None
 
-    def build(self, toolbar):
-        nuke_and_pave(os.path.join(self.group.dirpath, self.title))
+    def build(self, toolbar, pool=None, template=None):
+        with self.group.profile.phase("nuke"):
+            self.group.writer.prepare_dir(os.path.join(self.group.dirpath, self.title))
         for _, col in self.cols.items():
-            col.build(toolbar)
+            if not col.exists():
+                continue
+            if pool is None:
+                col.build(toolbar, template)
+            else:
+                pool.submit(col.getFilePath(), col.build, toolbar, template)
 
 
 class Group(object):
-    def __init__(self, root, parent, spec, rows):
+    def __init__(self, root, parent, spec, rows, profile=NULL_PROFILE, writer=PLAIN_WRITER, snapshot=None,
+                 source_root=None, thumbnails=None):
         title = spec["title"]
+        self.profile = profile
+        self.writer = writer
+        # Where the columns check for their files; see utils.FileSnapshot
+        self.snapshot = snapshot if snapshot is not None else FileSnapshot()
         self.dirname = slugify(title)
+        # Where the package's files are, if the group is being written somewhere else
+        self.source_root = source_root if source_root is not None else root
+        # Image path -> its thumbnail's path; see thumbnails.ThumbnailCache
+        self.thumbnails = thumbnails if thumbnails is not None else {}
         self.parent = parent
         self.dirpath = os.path.join(root, parent, self.dirname)
         self.rows = []
@@ -150,15 +292,17 @@ class Group(object):
     def getLink(self, row_ind, col_ind, level):
         return self.rows[row_ind].getLink(col_ind, level)
 
-    def build(self, toolbar):
-        nuke_and_pave(self.dirpath)
+    def build(self, toolbar, pool=None, template=None):
+        with self.profile.phase("nuke"):
+            self.writer.prepare_dir(self.dirpath)
 
         for r in self.rows:
-            r.build(toolbar)
+            r.build(toolbar, pool, template)
 
 
 class Page(object):
-    def __init__(self, spec, root_path="./", permissions=None):
+    def __init__(self, spec, root_path="./", permissions=None, column_workers=None, profile=None, writer=None,
+                 snapshot=None, output_path=None, thumbnails=None):
         self.name = spec.get("title", "")
         self.short_name = spec.get("short_name", None)
 
@@ -173,28 +317,43 @@ class Page(object):
                 self.groups.append({"title": g, "columns": columns})
             elif isinstance(g, dict):
                 if "columns" not in g:
-                    g["columns"] = columns
+                    # Copy rather than fill in the spec, which may be shared (see build.open_specs)
+                    g = dict(g, columns=columns)
                 self.number_of_cols = max(len(g["columns"]), self.number_of_cols)
                 self.groups.append(g)
         self.root_path = root_path
+        # Where the page is written; the package directory (root_path) unless the build is staged elsewhere
+        self.output_path = output_path if output_path is not None else root_path
+        # Image path -> its thumbnail's path, for the previews and icon; see thumbnails.ThumbnailCache
+        self.thumbnails = thumbnails if thumbnails is not None else {}
         self.permissions = permissions
+        # Number of threads to build column pages with; they're built in order when None
+        self.column_workers = column_workers
+        # Where build timings are recorded; see profiling.BuildProfile
+        self.profile = profile if profile is not None else NULL_PROFILE
+        # Writes the page's files; see output.OutputWriter
+        self.writer = writer if writer is not None else PLAIN_WRITER
+        # Answers whether the package's files exist; see utils.FileSnapshot
+        self.snapshot = snapshot if snapshot is not None else FileSnapshot()
         self.description = spec.get("description", "")
         self.icon = spec.get("icon", None)
         self.rows = spec.get("rows", [])
         self.long_desc = spec.get("long_description", "")
 
-    def build(self, dirname, toolbar=None):
-        nuke_and_pave(os.path.join(self.root_path, dirname))
-
+    def _document(self, toolbar):
+        """
+        Start the page's Document with its header and group navigator; returns (doc, container, select).
+        """
         doc = Document(title=self.name, level=1)
         if toolbar is not None:
-            doc.append(toolbar)
+            doc.append(toolbar.at_level(1))
         # Build the header, title, subtitle, etc.
         container = doc.append_tag("div", class_="container")
         row = container.append_tag("div", class_="row")
         title = row.append_tag("h1")
-        if self.icon is not None and os.path.exists(os.path.join(self.root_path, self.icon)):
-            title.append_tag("img", src="../" + self.icon, width="200px", alt=self.name)
+        if self.icon is not None and self.snapshot.exists(os.path.join(self.root_path, self.icon)):
+            icon = self.thumbnails.get(self.icon, self.icon)
+            title.append_tag("img", src="../" + icon, width="200px", alt=self.name)
         title.append(self.name)
         if self.description:
             subtitle = row.append_tag("h2")
@@ -210,56 +369,149 @@ class Page(object):
         label = col.append_tag("label")
         label.append("Jump To:")
         select = col.append_tag("select", class_="form-control group_navigator")
+        return doc, container, select
+
+    def _column_widths(self, column_names):
+        # Pad the columns so they're appropriately spaced
+        column_widths = [1 for i in range(len(column_names) + 1)]
+        difflen = self.number_of_cols - len(column_names)
+        col_ind = len(column_widths) - 1
+        while difflen > 0:
+            column_widths[col_ind] += 1
+            difflen -= 1
+            col_ind = (col_ind - 1) % len(column_widths)
+        return column_widths
+
+    def build(self, dirname, toolbar=None, lazy=False):
+        """
+        Build the page as index.html plus an HTML file for each column of each row.
+
+        If lazy is True, index.html only has the group headers, and each group's rows
+        go in a rows.html fragment in the group's directory for viewer.js to load
+        when the group is opened or navigated to.
+        """
+        profile = self.profile.page(dirname)
+        with profile.phase("nuke"):
+            self.writer.prepare_dir(os.path.join(self.output_path, dirname))
+
+        with profile.phase("tree"):
+            doc, container, select = self._document(toolbar)
+
+            # Start the actual body of the output set
+            row = container.append_tag("div", class_="row")
+            col = row.append_tag("div", class_="col-sm-12")
+            table = Table(class_="table")
+            col.append(table)
+
+        # Renders the column pages from a pre-rendered toolbar, so it's safe to share between threads
+        with profile.phase("serialize"):
+            template = ColumnTemplate(toolbar)
+        pool = None
+        if self.column_workers is not None and self.column_workers > 1:
+            pool = BoundedThreadPool(self.column_workers)
+        try:
+            self._build_groups(dirname, toolbar, table, select, pool, template, profile, lazy)
+        finally:
+            failures = pool.close() if pool is not None else []
+        if failures:
+            raise BuildError(failures)
+
+        self.writer.write_chunks(os.path.join(self.output_path, dirname, "index.html"), doc.iter_chunks(), profile)
+        with profile.phase("nuke"):
+            self.writer.sweep(os.path.join(self.output_path, dirname), profile)
 
-        # Start the actual body of the output set
-        row = container.append_tag("div", class_="row")
-        col = row.append_tag("div", class_="col-sm-12")
-        table = Table(class_="table")
-        col.append(table)
+        if self.permissions is not None:
+            with profile.phase("rechmod"):
+                rechmod(os.path.join(self.output_path, dirname), self.permissions)
+        profile.finish()
 
+    def _build_groups(self, dirname, toolbar, table, select, pool, template, profile, lazy=False):
         for group_ind, rows in enumerate(self.rows):
             group = self.groups[group_ind]
             column_names = group["columns"]
             group_title = group["title"]
             select.append_tag("option", value="group_%d" % group_ind).append(group_title)
 
-            # Pad the columns so they're appropriately spaced
-            column_widths = [1 for i in range(len(column_names) + 1)]
-            difflen = self.number_of_cols - len(column_names)
-            col_ind = len(column_widths) - 1
-            while difflen > 0:
-                column_widths[col_ind] += 1
-                difflen -= 1
-                col_ind = (col_ind - 1) % len(column_widths)
+            with profile.phase("tree"):
+                group_obj = Group(self.output_path, dirname, group, rows, profile, self.writer, self.snapshot,
+                                  self.root_path, self.thumbnails)
+                if lazy:
+                    # Relative to index.html, like the links in the rows
+                    header = table.append_header(data={"rows": group_obj.dirname + "/rows.html"})
+                else:
+                    header = table.append_header()
+                column_widths = [str(i) for i in self._column_widths(column_names)]
+                header.append_cell(group_title, id="group_%d" % group_ind)
+                for col_ind in range(len(column_names)):
+                    header.append_cell(column_names[col_ind], colspan=column_widths[col_ind])
+
+                # Rendered in bulk rather than as a TableRow per row; cells past the last column aren't shown
+                table_rows = []
+                for row_ind, r in enumerate(rows):
+                    cols = group_obj.rows[row_ind].cols
+                    cells = [cols[col_ind].getCell(1) if col_ind in cols else col
+                             for col_ind, col in enumerate(r["columns"][:len(column_widths)])]
+                    table_rows.append(("<span>%s</span>" % r["title"], cells))
+                if lazy:
+                    fragment = TableRows(table_rows, column_widths, class_="output-row")
+                else:
+                    table.append_rows(table_rows, column_widths, class_="output-row")
+            group_obj.build(toolbar, pool, template)
+            if lazy:
+                self.writer.write_chunks(os.path.join(group_obj.dirpath, "rows.html"), fragment.iter_chunks(), profile)
+
+    def build_spa(self, dirname, toolbar=None):
+        """
+        Build the page as a single index.html plus a data.json describing its groups.
+
+        viewer.js renders the group tables and the column views from data.json,
+        so a column page that build() would write to group/row/column.html is
+        shown at index.html#group/row/column.html instead.
+        """
+        profile = self.profile.page(dirname)
+        page_dir = os.path.join(self.output_path, dirname)
+        with profile.phase("nuke"):
+            self.writer.prepare_dir(page_dir)
+
+        with profile.phase("tree"):
+            doc, container, select = self._document(toolbar)
+            container.append_tag("div", class_="spa_view", data={"src": "data.json"})
+            groups = self._spa_groups(dirname, select)
+
+        with profile.phase("serialize"):
+            data = json.dumps({"groups": groups}, separators=(",", ":"))
+        self.writer.write_file(os.path.join(page_dir, "data.json"), data, profile)
+
+        self.writer.write_chunks(os.path.join(page_dir, "index.html"), doc.iter_chunks(), profile)
+        with profile.phase("nuke"):
+            self.writer.sweep(page_dir, profile)
 
-            header = table.append_header()
-            column_widths = [str(i) for i in column_widths]
-            header.append_cell(group_title, id="group_%d" % group_ind)
-            for col_ind in range(len(column_names)):
-                header.append_cell(column_names[col_ind], colspan=column_widths[col_ind])
+        if self.permissions is not None:
+            with profile.phase("rechmod"):
+                rechmod(page_dir, self.permissions)
+        profile.finish()
 
-            group_obj = Group(self.root_path, dirname, group, rows)
+    def _spa_groups(self, dirname, select):
+        groups = []
+        for group_ind, rows in enumerate(self.rows):
+            group = self.groups[group_ind]
+            select.append_tag("option", value="group_%d" % group_ind).append(group["title"])
+            column_widths = self._column_widths(group["columns"])
+            group_obj = Group(self.output_path, dirname, group, rows, snapshot=self.snapshot,
+                              source_root=self.root_path, thumbnails=self.thumbnails)
 
+            group_rows = []
             for row_ind, r in enumerate(rows):
-                tr = table.append_row(class_="output-row")
-                cell = TableCell()
-                cell.append_formatted("<span>%s</span>" % r["title"])
-                tr.append(cell)
-                for col_ind, col in enumerate(r["columns"]):
-                    l = group_obj.getLink(row_ind, col_ind, 1)
-                    if l is None:
-                        l = col
-                    try:
-                        tr.append_cell(l, colspan=column_widths[col_ind])
-                    except IndexError:
-                        pass
-            group_obj.build(toolbar)
-
-        with open(os.path.join(self.root_path, dirname, "index.html"), "w") as outfile:
-            if toolbar is not None:
-                toolbar.setLevel(1)
-
-            outfile.write(doc.build())
-
-        if self.permissions is not None:
-            rechmod(os.path.join(self.root_path, dirname), self.permissions)
+                cols = group_obj.rows[row_ind].cols
+                cells = []
+                # Cells past the last column aren't shown (see _build_groups)
+                for col_ind, col in enumerate(r["columns"][:len(column_widths)]):
+                    cells.append(cols[col_ind].toDict() if col_ind in cols else col)
+                group_rows.append({"title": r["title"], "cells": cells})
+            groups.append({
+                "title": group["title"],
+                "columns": group["columns"],
+                "widths": column_widths,
+                "rows": group_rows,
+            })
+        return groups
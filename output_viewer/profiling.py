@@ -0,0 +1,230 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+import threading
+import json
+import time
+
+
+class BuildProfile(object):
+    """
+    Collects how long each phase of a build took, and how many files and bytes it wrote.
+
+    Phases are "load" (reading the index), "tree" (building HTMLBuilder trees),
+    "serialize" (turning them into HTML), "nuke" (clearing output directories),
+    "write", "rechmod", "assets" (the viewer's static files), "thumbnails",
+    and "publish" (moving a staged build into place). Times are
+    summed over threads, so with column_workers they can add up to more than
+    the wall time.
+
+    page(name) returns a child profile for one page; anything recorded on it is
+    added to this profile too.
+
+    With output.OutputWriter's minify and compress options, it also records the
+    bytes minifying saved and the sizes of the files before and after compression;
+    with its diff option, how many files were left unchanged and how many removed.
+    """
+    def __init__(self, parent=None):
+        self._parent = parent
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+        self.wall_time = None
+        self.phases = OrderedDict()
+        self.files_written = 0
+        self.bytes_written = 0
+        self.bytes_minified = 0
+        self.files_compressed = 0
+        self.bytes_before_compression = 0
+        self.bytes_after_compression = 0
+        self.files_unchanged = 0
+        self.files_removed = 0
+        self.pages = OrderedDict()
+
+    def page(self, name):
+        with self._lock:
+            if name not in self.pages:
+                self.pages[name] = BuildProfile(parent=self)
+            return self.pages[name]
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name, seconds):
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+        if self._parent is not None:
+            self._parent.add_time(name, seconds)
+
+    def wrote(self, nbytes, files=1):
+        with self._lock:
+            self.files_written += files
+            self.bytes_written += nbytes
+        if self._parent is not None:
+            self._parent.wrote(nbytes, files)
+
+    def minified(self, saved):
+        with self._lock:
+            self.bytes_minified += saved
+        if self._parent is not None:
+            self._parent.minified(saved)
+
+    def compressed(self, original, compressed, files=1):
+        with self._lock:
+            self.files_compressed += files
+            self.bytes_before_compression += original
+            self.bytes_after_compression += compressed
+        if self._parent is not None:
+            self._parent.compressed(original, compressed, files)
+
+    def unchanged(self, files=1):
+        with self._lock:
+            self.files_unchanged += files
+        if self._parent is not None:
+            self._parent.unchanged(files)
+
+    def removed(self, files=1):
+        with self._lock:
+            self.files_removed += files
+        if self._parent is not None:
+            self._parent.removed(files)
+
+    def iterate(self, phase, iterable):
+        """
+        Yield from iterable, timing each step against phase.
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.phase(phase):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def finish(self):
+        self.wall_time = time.perf_counter() - self._start
+        return self
+
+    def merge(self, data):
+        """
+        Add in a profile that was recorded elsewhere (e.g. in a worker process), as returned by to_dict.
+        """
+        for name, seconds in data["phases"].items():
+            self.add_time(name, seconds)
+        self.wrote(data["bytes_written"], data["files_written"])
+        self.minified(data["bytes_minified"])
+        compression = data["compression"]
+        self.compressed(compression["bytes_before"], compression["bytes_after"], compression["files"])
+        self.unchanged(data["files_unchanged"])
+        self.removed(data["files_removed"])
+        for name, page_data in data.get("pages", {}).items():
+            page = self.page(name)
+            # Counted above already; only fill in the page's own breakdown
+            with page._lock:
+                for phase, seconds in page_data["phases"].items():
+                    page.phases[phase] = page.phases.get(phase, 0.0) + seconds
+                page.files_written += page_data["files_written"]
+                page.bytes_written += page_data["bytes_written"]
+                page.bytes_minified += page_data["bytes_minified"]
+                page.files_compressed += page_data["compression"]["files"]
+                page.bytes_before_compression += page_data["compression"]["bytes_before"]
+                page.bytes_after_compression += page_data["compression"]["bytes_after"]
+                page.files_unchanged += page_data["files_unchanged"]
+                page.files_removed += page_data["files_removed"]
+                page.wall_time = page_data["wall_time"]
+
+    def to_dict(self):
+        return {
+            "wall_time": self.wall_time,
+            "phases": dict(self.phases),
+            "files_written": self.files_written,
+            "bytes_written": self.bytes_written,
+            "bytes_minified": self.bytes_minified,
+            "compression": {
+                "files": self.files_compressed,
+                "bytes_before": self.bytes_before_compression,
+                "bytes_after": self.bytes_after_compression,
+            },
+            "files_unchanged": self.files_unchanged,
+            "files_removed": self.files_removed,
+            "pages": OrderedDict((name, page.to_dict()) for name, page in self.pages.items()),
+        }
+
+    def dump(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def report(self):
+        """
+        Human-readable summary, one line per phase and per page.
+        """
+        lines = ["Total: %.3fs, %d files, %d bytes" % (self.wall_time or 0.0, self.files_written, self.bytes_written)]
+        lines.extend(self.savings())
+        for name, seconds in self.phases.items():
+            lines.append("  %-10s %8.3fs" % (name, seconds))
+        for name, page in self.pages.items():
+            lines.append("%s: %.3fs, %d files, %d bytes" % (name, page.wall_time or 0.0, page.files_written,
+                                                            page.bytes_written))
+            for phase, seconds in page.phases.items():
+                lines.append("  %-10s %8.3fs" % (phase, seconds))
+        return "\n".join(lines)
+
+    def savings(self):
+        """
+        Lines describing what minifying, compressing, and only writing changed files saved,
+        if any of them were done.
+        """
+        lines = []
+        if self.bytes_minified:
+            lines.append("Minified: saved %d bytes" % self.bytes_minified)
+        if self.files_compressed:
+            before, after = self.bytes_before_compression, self.bytes_after_compression
+            lines.append("Compressed: %d files, %d -> %d bytes (%.1f%% smaller)" % (
+                self.files_compressed, before, after, 100.0 * (before - after) / before))
+        if self.files_unchanged or self.files_removed:
+            lines.append("Updated: %d files written, %d unchanged, %d removed" % (
+                self.files_written, self.files_unchanged, self.files_removed))
+        return lines
+
+
+class NullProfile(object):
+    """
+    Stand-in for BuildProfile when nothing is being profiled.
+    """
+    def page(self, name):
+        return self
+
+    @contextmanager
+    def phase(self, name):
+        yield
+
+    def add_time(self, name, seconds):
+        pass
+
+    def wrote(self, nbytes, files=1):
+        pass
+
+    def minified(self, saved):
+        pass
+
+    def compressed(self, original, compressed, files=1):
+        pass
+
+    def unchanged(self, files=1):
+        pass
+
+    def removed(self, files=1):
+        pass
+
+    def iterate(self, phase, iterable):
+        return iterable
+
+    def finish(self):
+        return self
+
+
+NULL_PROFILE = NullProfile()
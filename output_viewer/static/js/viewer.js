@@ -1,5 +1,15 @@
-$("body").ready(function(){
-	$("a[data-preview$='.png']").popover({
+var right_arrow = "right_arrow";
+var down_arrow = "down_arrow";
+
+var arrow_registry = {
+	"left": undefined,
+	"right": undefined,
+	"down": undefined,
+	"up": undefined
+};
+
+function bindPreviews(root) {
+	$(root).find("a[data-preview$='.png']").popover({
 		"content": function(){
 			var link = $(this);
 			var img_url = link.attr("data-preview");
@@ -11,11 +21,10 @@ $("body").ready(function(){
 		"placement": "left",
 		"html": true
 	});
+}
 
-	var right_arrow = "right_arrow";
-	var down_arrow = "down_arrow";
-
-	$(".disclosable").each(function() {
+function bindDisclosable(root) {
+	$(root).find(".disclosable").each(function() {
 		var self = $(this);
 		var title_area = $(document.createElement("div")).addClass("disclosable_header");
 		var text = self.attr("data-title");
@@ -32,20 +41,234 @@ $("body").ready(function(){
 			title_area.toggleClass(down_arrow).toggleClass(right_arrow);
 		});
 	});
+}
 
-	var arrow_registry = {
-		"left": undefined,
-		"right": undefined,
-		"down": undefined,
-		"up": undefined
-	};
-
-	$("*[data-arrow]").each(function(){
+function bindArrows(root) {
+	for (var arrow in arrow_registry) {
+		arrow_registry[arrow] = undefined;
+	}
+	$(root).find("*[data-arrow]").each(function(){
 		var self = $(this);
 		var arrow = self.attr("data-arrow");
 		var f = function() {self.click();};
 		arrow_registry[arrow] = f;
 	});
+}
+
+function bindDownloads(root) {
+	$(root).find(".download_urls").change(function(){
+		var new_url = $(this).val();
+		$(".download_link").attr("href", new_url);
+	});
+}
+
+// Lazy mode: a group's rows are in a separate file (data-rows on its header row),
+// fetched the first time the group is opened or navigated to.
+function openGroup(header, done) {
+	var title = header.children().first();
+	title.removeClass(right_arrow).addClass(down_arrow);
+	var rows = header.data("group_rows");
+	if (rows !== undefined) {
+		rows.show();
+		if (done !== undefined) {
+			done();
+		}
+		return;
+	}
+	if (header.data("loading")) {
+		return;
+	}
+	header.data("loading", true);
+	$.get(header.attr("data-rows"), function(html) {
+		rows = $(html).filter("tr");
+		rows.insertAfter(header);
+		bindPreviews(rows);
+		header.data("group_rows", rows).data("loading", false);
+		if (title.hasClass(right_arrow)) {
+			// Closed again while it was loading
+			rows.hide();
+		} else if (done !== undefined) {
+			done();
+		}
+	}, "html");
+}
+
+function closeGroup(header) {
+	header.children().first().removeClass(down_arrow).addClass(right_arrow);
+	var rows = header.data("group_rows");
+	if (rows !== undefined) {
+		rows.hide();
+	}
+}
+
+function bindLazyGroups(root) {
+	var headers = $(root).find("tr[data-rows]");
+	if (headers.length === 0) {
+		return;
+	}
+	headers.each(function() {
+		var header = $(this);
+		header.children().first().addClass(right_arrow);
+		header.css("cursor", "pointer").click(function() {
+			if (header.children().first().hasClass(down_arrow)) {
+				closeGroup(header);
+			} else {
+				openGroup(header);
+			}
+		});
+	});
+
+	function navigate() {
+		var target = decodeURIComponent(window.location.hash.substr(1));
+		var anchor = target ? document.getElementById(target) : null;
+		if (anchor === null) {
+			return;
+		}
+		var header = $(anchor).closest("tr[data-rows]");
+		if (header.length !== 0) {
+			openGroup(header, function() {
+				anchor.scrollIntoView();
+			});
+		}
+	}
+	$(window).on("hashchange", navigate);
+	navigate();
+}
+
+// Single-page mode: the page's groups come from a data file, and column views are
+// addressed by the hash (index.html#group/row/column.html).
+function spaTable(data) {
+	var table = $("<table>").addClass("table");
+	$.each(data.groups, function(group_ind, group) {
+		var header = $("<tr>").appendTo(table);
+		$("<th>").attr("id", "group_" + group_ind).text(group.title).appendTo(header);
+		$.each(group.columns, function(col_ind, name) {
+			$("<th>").attr("colspan", group.widths[col_ind]).text(name).appendTo(header);
+		});
+		$.each(group.rows, function(row_ind, row) {
+			var tr = $("<tr>").addClass("output-row").appendTo(table);
+			$("<td>").append($("<span>").html(row.title)).appendTo(tr);
+			$.each(row.cells, function(col_ind, cell) {
+				var td = $("<td>").attr("colspan", group.widths[col_ind]).appendTo(tr);
+				if (cell === null || typeof cell !== "object") {
+					td.text(cell === null ? "None" : cell);
+				} else if (cell.exists) {
+					$("<a>").attr("href", "#" + cell.url).attr("data-preview", cell.preview).text(cell.title).appendTo(td);
+				} else {
+					$("<span>").text(cell.title).appendTo(td);
+				}
+			});
+		});
+	});
+	return $("<div>").addClass("row").append($("<div>").addClass("col-sm-12").append(table));
+}
+
+function spaColumnLink(target, direction, arrow, label) {
+	var form = $("<form>").addClass("col_link " + direction);
+	$("<button>").attr("type", "button").attr("data-arrow", arrow).text(label).click(function(){
+		window.location.hash = target.url;
+	}).appendTo(form);
+	return form;
+}
+
+function spaColumn(column) {
+	var view = $("<div>");
+	$("<div>").addClass("row").append($("<h1>").addClass("img_title").text(column.title)).appendTo(view);
+
+	var file_div = $("<div>").addClass("img_display");
+	$("<div>").addClass("row").append($("<div>").addClass("col-sm-12").append(file_div)).appendTo(view);
+	if (column.image) {
+		$("<img>").attr("src", column.path).appendTo(file_div);
+	}
+	var downloads = $("<div>").appendTo(file_div);
+	$("<label>").text("Files:").appendTo(downloads);
+	var select = $("<select>").addClass("form-control download_urls").appendTo(downloads);
+	$.each(column.files, function(i, f) {
+		$("<option>").attr("value", f[0]).text(f[1]).appendTo(select);
+	});
+	$("<a>").addClass("btn btn-primary download_link").attr("download", "").attr("href", column.files[0][0]).text("Download").appendTo(downloads);
+
+	var disclose_div = $("<div>").addClass("disclosable row").attr("data-title", "Output Metadata").appendTo(view);
+	var table = $("<table>").addClass("table").appendTo(disclose_div);
+	$("<tr>").append($("<th>").css("min-width", "15%").text("Metadata Key")).append($("<th>").text("Metadata Value")).appendTo(table);
+	$.each(column.meta, function(key, value) {
+		$("<tr>").append($("<td>").text(key)).append($("<td>").text(value)).appendTo(table);
+	});
+
+	if (column.prev !== undefined) {
+		spaColumnLink(column.prev, "back", "left", "<").appendTo(view);
+	}
+	if (column.next !== undefined) {
+		spaColumnLink(column.next, "next", "right", ">").appendTo(view);
+	}
+	return view;
+}
+
+function spaView(view) {
+	var page_title = document.title;
+	// Everything else on the page (title, group navigator) only belongs with the table
+	var header = view.siblings();
+	var columns = {};
+	var table = null;
+
+	function route() {
+		var target = decodeURIComponent(window.location.hash.substr(1));
+		var column = columns[target];
+		if (table !== null) {
+			table.find("[data-preview]").popover("hide");
+		}
+		view.children().detach();
+		if (column !== undefined) {
+			header.hide();
+			document.title = column.title;
+			var column_view = spaColumn(column);
+			view.append(column_view);
+			bindDisclosable(column_view);
+			bindDownloads(column_view);
+			bindArrows(column_view);
+			window.scrollTo(0, 0);
+		} else {
+			header.show();
+			document.title = page_title;
+			view.append(table);
+			bindArrows(table);
+			var anchor = target ? document.getElementById(target) : null;
+			if (anchor !== null) {
+				anchor.scrollIntoView();
+			}
+		}
+	}
+
+	$.getJSON(view.attr("data-src"), function(data) {
+		$.each(data.groups, function(group_ind, group) {
+			$.each(group.rows, function(row_ind, row) {
+				var prev;
+				$.each(row.cells, function(col_ind, cell) {
+					// Missing outputs aren't linked to, and are skipped by the back/next links
+					if (cell === null || typeof cell !== "object" || !cell.exists) {
+						return;
+					}
+					columns[cell.url] = cell;
+					if (prev !== undefined) {
+						cell.prev = prev;
+						prev.next = cell;
+					}
+					prev = cell;
+				});
+			});
+		});
+		table = spaTable(data);
+		bindPreviews(table);
+		$(window).on("hashchange", route);
+		route();
+	});
+}
+
+$("body").ready(function(){
+	bindPreviews(document);
+	bindDisclosable(document);
+	bindArrows(document);
+	bindDownloads(document);
 
 	document.onkeydown = function(e) {
 		var arrow = null;
@@ -74,8 +297,9 @@ $("body").ready(function(){
 		window.location.hash = new_id;
 	});
 
-	$(".download_urls").change(function(){
-		var new_url = $(this).val();
-		$(".download_link").attr("href", new_url);
-	})
-});
\ No newline at end of file
+	bindLazyGroups(document);
+
+	$(".spa_view").each(function(){
+		spaView($(this));
+	});
+});
@@ -0,0 +1,115 @@
+import json
+
+
+SPECIFICATION = "specification"
+
+
+class _Reader(object):
+    """
+    Decodes JSON values one at a time from a file, holding only a window of it in memory.
+    """
+    def __init__(self, fp, chunk_size):
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _read(self, size):
+        if self.pos > self.chunk_size:
+            # Drop everything that's already been consumed
+            self.buf = self.buf[self.pos:]
+            self.pos = 0
+        data = self.fp.read(size)
+        if not data:
+            self.eof = True
+        self.buf += data
+
+    def peek(self):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in " \t\n\r":
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if self.eof:
+                return ""
+            self._read(self.chunk_size)
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise ValueError("Expected '%s' at offset %d, found '%s'" % (char, self.pos, found))
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # A value running into the end of the buffer (like a number) might continue in the next chunk
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            # Grow by at least the size of the partial value, so big values aren't re-parsed too often
+            self._read(max(self.chunk_size, len(self.buf) - self.pos))
+
+
+def iter_index(index_file, chunk_size=1 << 16):
+    """
+    Incrementally parse an index.json file object.
+
+    Yields (key, value) for each top-level key, except for the specification, where
+    it yields ("specification", plotspec) for each plotspec in turn. Only one plotspec
+    is held in memory at a time.
+    """
+    reader = _Reader(index_file, chunk_size)
+    reader.expect("{")
+    if reader.peek() == "}":
+        return
+    while True:
+        key = reader.value()
+        reader.expect(":")
+        if key == SPECIFICATION and reader.peek() == "[":
+            reader.expect("[")
+            if reader.peek() == "]":
+                reader.pos += 1
+            else:
+                while True:
+                    yield key, reader.value()
+                    if reader.peek() == "]":
+                        reader.pos += 1
+                        break
+                    reader.expect(",")
+        else:
+            yield key, reader.value()
+        if reader.peek() == "}":
+            return
+        reader.expect(",")
+
+
+def read_header(index_path):
+    """
+    Return the top-level keys of the index at index_path, without the specification.
+
+    The whole file is scanned (so this also validates it), but plotspecs are discarded as they're read.
+    """
+    header = {}
+    with open(index_path) as index_file:
+        for key, value in iter_index(index_file):
+            if key != SPECIFICATION:
+                header[key] = value
+    return header
+
+
+def iter_plotspecs(index_path):
+    """
+    Yield the plotspecs of the index at index_path one at a time.
+    """
+    with open(index_path) as index_file:
+        for key, value in iter_index(index_file):
+            if key == SPECIFICATION:
+                yield value
@@ -0,0 +1,123 @@
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from PIL import Image
+except ImportError:
+    # Pillow is optional; without it, previews and icons use the full-size images
+    Image = None
+
+
+# Where thumbnails are kept, relative to the package directory
+THUMBNAIL_DIR = "thumbnails"
+# Thumbnails are scaled down to fit in this
+THUMBNAIL_SIZE = (400, 400)
+# viewer.js only shows hover previews of PNGs
+PREVIEW_FORMATS = (".png",)
+ICON_FORMATS = (".png", ".jpg", ".jpeg", ".gif", ".bmp", ".tif", ".tiff", ".webp")
+
+
+def thumbnails_available():
+    return Image is not None
+
+
+def thumbnail_name(path, st):
+    """
+    Path (relative to the package) of the thumbnail of the image at path, given its os.stat() result.
+    """
+    key = "%s:%d:%d" % (path, st.st_mtime_ns, st.st_size)
+    return "%s/%s.png" % (THUMBNAIL_DIR, hashlib.sha1(key.encode("utf-8")).hexdigest()[:16])
+
+
+def image_paths(plotspec):
+    """
+    The images of a plotspec that are worth making thumbnails of: its icon, and the columns that get previews.
+    """
+    paths = []
+    icon = plotspec.get("icon")
+    if icon and icon.lower().endswith(ICON_FORMATS):
+        paths.append(icon)
+    for rows in plotspec.get("rows", []):
+        for row in rows:
+            for col in row["columns"]:
+                if isinstance(col, dict) and col.get("path", "").lower().endswith(PREVIEW_FORMATS):
+                    paths.append(col["path"])
+    return paths
+
+
+def make_thumbnail(source, dest, size=THUMBNAIL_SIZE, mode=None):
+    """
+    Write a PNG of the image at source, scaled down to fit in size, to dest (with permissions
+    mode, if given); runs in a worker process.
+    """
+    image = Image.open(source)
+    image.thumbnail(size)
+    if image.mode not in ("1", "L", "LA", "P", "RGB", "RGBA"):
+        image = image.convert("RGBA")
+    tmp_path = "%s.tmp-%d" % (dest, os.getpid())
+    image.save(tmp_path, "PNG", optimize=True)
+    if mode is not None:
+        os.chmod(tmp_path, mode)
+    os.replace(tmp_path, dest)
+
+
+class ThumbnailCache(object):
+    """
+    Scaled-down copies of a package's images, for the hover previews and page icons.
+
+    They're kept in THUMBNAIL_DIR under the package, named by a hash of each source
+    image's path, mtime and size, so a thumbnail is only made again when its source
+    changes. Missing ones are made on a pool of worker processes (workers of them, or
+    one per CPU by default), and given default_mask's permissions, like the rest of the
+    build. Without Pillow, no thumbnails are made and the full images are used.
+
+    Thumbnails that are no longer used aren't removed; delete THUMBNAIL_DIR to clear them out.
+    """
+    def __init__(self, root, workers=None, default_mask=None):
+        self.root = root
+        self.workers = workers
+        self.default_mask = default_mask
+        self._pool = None
+
+    def thumbnails(self, paths):
+        """
+        Return {path: thumbnail path} for each of paths (relative to the package) that's an
+        image with a thumbnail, making any that are missing. Paths that don't exist, or
+        can't be read as images, are left out.
+        """
+        if Image is None:
+            return {}
+        found = {}
+        pending = {}
+        for path in set(paths):
+            try:
+                st = os.stat(os.path.join(self.root, path))
+            except OSError:
+                continue
+            name = thumbnail_name(path, st)
+            dest = os.path.join(self.root, name)
+            if os.path.exists(dest):
+                found[path] = name
+                continue
+            if self._pool is None:
+                thumbnail_dir = os.path.join(self.root, THUMBNAIL_DIR)
+                os.makedirs(thumbnail_dir, exist_ok=True)
+                if self.default_mask is not None:
+                    os.chmod(thumbnail_dir, self.default_mask)
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+            pending[path] = (name, self._pool.submit(make_thumbnail, os.path.join(self.root, path), dest,
+                                                     THUMBNAIL_SIZE, self.default_mask))
+        for path, (name, future) in pending.items():
+            try:
+                future.result()
+            except Exception as e:
+                print("Unable to make a thumbnail of '%s': %s" % (path, e))
+            else:
+                found[path] = name
+        return found
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
@@ -1,7 +1,11 @@
 import unicodedata
+import threading
+import hashlib
 import shutil
 import os
 import re
+from concurrent.futures import ThreadPoolExecutor
+from .profiling import NULL_PROFILE
 
 
 def slugify(value):
@@ -20,6 +24,143 @@ def nuke_and_pave(path):
     os.mkdir(path)
 
 
+def dir_checksum(path):
+    """
+    SHA1 over the relative paths and contents of every file under path.
+    """
+    digest = hashlib.sha1()
+    for dirpath, dirs, files in os.walk(path):
+        dirs.sort()
+        for f in sorted(files):
+            full_path = os.path.join(dirpath, f)
+            digest.update(os.path.relpath(full_path, path).encode("utf-8"))
+            with open(full_path, "rb") as fp:
+                digest.update(fp.read())
+    return digest.hexdigest()
+
+
+def link_or_copy(src, dst):
+    """
+    Hardlink src to dst, copying instead when that isn't possible (e.g. across filesystems).
+    """
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+    return dst
+
+
+def swap_in(new_path, path):
+    """
+    Replace path (a file, directory, or symlink) with new_path, keeping the
+    window where path doesn't exist down to a pair of renames.
+    """
+    new_is_dir = os.path.isdir(new_path) and not os.path.islink(new_path)
+    old_is_dir = os.path.isdir(path) and not os.path.islink(path)
+    if not os.path.lexists(path) or (not new_is_dir and not old_is_dir):
+        # Renaming a file or symlink over a file or symlink (or nothing) is atomic
+        os.replace(new_path, path)
+        return
+    old_path = "%s.old-%d" % (path, os.getpid())
+    os.rename(path, old_path)
+    os.rename(new_path, path)
+    remove_path(old_path)
+
+
+def move_in(new_path, path):
+    """
+    swap_in() for a new_path that may be on another filesystem (like a staging
+    directory on tmpfs); it's moved next to path first, so the swap is still
+    just renames.
+    """
+    parent = os.path.dirname(os.path.abspath(path))
+    if os.lstat(new_path).st_dev != os.stat(parent).st_dev:
+        incoming = "%s.new-%d" % (path, os.getpid())
+        remove_path(incoming)
+        shutil.move(new_path, incoming)
+        new_path = incoming
+    swap_in(new_path, path)
+
+
+def remove_path(path):
+    """
+    Remove a file, symlink, or directory tree, if there's anything at path.
+    """
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+def write_file(path, content, profile=NULL_PROFILE):
+    """
+    Write the string content to path, recording it on profile.
+    """
+    with profile.phase("write"):
+        with open(path, "w") as out:
+            out.write(content)
+    profile.wrote(len(content))
+
+
+def write_chunks(path, chunks, profile=NULL_PROFILE):
+    """
+    Write each string from the iterable chunks to path as it's produced, so the whole file is
+    never in memory. Producing the chunks is recorded on profile as "serialize".
+    """
+    written = 0
+    with open(path, "w") as out:
+        for chunk in profile.iterate("serialize", chunks):
+            with profile.phase("write"):
+                out.write(chunk)
+            written += len(chunk)
+    profile.wrote(written)
+
+
+class FileSnapshot(object):
+    """
+    Answers whether paths exist from a single os.scandir() of each directory, taken the
+    first time anything in it is asked about, instead of a stat() per check. One snapshot
+    can be shared by every page of a build.
+
+    Files created or removed in a directory after it's been scanned aren't noticed.
+    """
+    def __init__(self):
+        # Directory path (as asked for, and absolute) -> set of the names in it
+        self._listings = {}
+
+    def listing(self, dirpath):
+        names = self._listings.get(dirpath)
+        if names is None:
+            abs_path = os.path.abspath(dirpath)
+            names = self._listings.get(abs_path)
+            if names is None:
+                names = self._scan(abs_path)
+                self._listings[abs_path] = names
+            self._listings[dirpath] = names
+        return names
+
+    def exists(self, path):
+        dirpath, name = os.path.split(path)
+        if name in ("", ".", ".."):
+            dirpath, name = os.path.split(os.path.abspath(path))
+            if not name:
+                # The filesystem root
+                return os.path.exists(path)
+        return name in self.listing(dirpath)
+
+    def _scan(self, dirpath):
+        names = set()
+        try:
+            with os.scandir(dirpath) as entries:
+                for entry in entries:
+                    # These follow symlinks, so broken ones are left out like os.path.exists does
+                    if entry.is_file() or entry.is_dir():
+                        names.add(entry.name)
+        except OSError:
+            pass
+        return names
+
+
 def rechmod(path, perms):
     os.chmod(path, perms)
     for path, dirs, files in os.walk(path):
@@ -27,3 +168,37 @@ def rechmod(path, perms):
             os.chmod(f, perms)
         for d in [os.path.join(path, d) for d in dirs]:
             os.chmod(d, perms)
+
+
+class BoundedThreadPool(object):
+    """
+    Runs jobs on a fixed number of threads, blocking submit() once max_pending
+    jobs are queued or running so callers can't get arbitrarily far ahead.
+
+    Errors don't stop other jobs; they're collected as (label, exception) pairs
+    and returned by close().
+    """
+    def __init__(self, workers, max_pending=None):
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._slots = threading.BoundedSemaphore(max_pending or workers * 4)
+        self._lock = threading.Lock()
+        self.errors = []
+
+    def submit(self, label, func, *args):
+        self._slots.acquire()
+        future = self._executor.submit(func, *args)
+        future.add_done_callback(lambda f: self._done(label, f))
+
+    def _done(self, label, future):
+        error = future.exception()
+        if error is not None:
+            with self._lock:
+                self.errors.append((label, error))
+        self._slots.release()
+
+    def close(self):
+        """
+        Wait for all submitted jobs and return the errors they raised.
+        """
+        self._executor.shutdown(wait=True)
+        return self.errors
@@ -6,7 +6,32 @@ from output_viewer.build import build_viewer
 parser = ArgumentParser(description="Generate HTML pages for viewing output.")
 parser.add_argument('path', help="Path to index file for output.", default="index.json", nargs="?")
 parser.add_argument('--dataset', help="Name of your output", default="AIMS Output Viewer")
+parser.add_argument('--incremental', help="Only rebuild pages that changed since the last build.", action="store_true")
+parser.add_argument('--profile', help="Print where the build spent its time.", action="store_true")
+parser.add_argument('--profile-json', help="Write where the build spent its time to PATH as JSON.", default=None, metavar="PATH")
+parser.add_argument('--mode', help="'pages' writes an HTML file per output; 'lazy' does too, but each group's rows are only loaded once it's opened; 'spa' writes one page plus data that the viewer renders in the browser.", choices=["pages", "lazy", "spa"], default="pages")
+parser.add_argument('--jobs', '-j', help="Number of processes to build pages with.", type=int, default=None)
+parser.add_argument('--threads', help="Number of threads each page builds its column pages with.", type=int, default=None)
+parser.add_argument('--link-assets', help="Link to the installed viewer assets instead of copying them.", choices=["hardlink", "symlink"], default=None)
+parser.add_argument('--stream', help="Read the index one page at a time to keep memory use down.", action="store_true")
+parser.add_argument('--minify', help="Write minified HTML.", action="store_true")
+parser.add_argument('--compress', help="Write a gzipped copy of each file next to it, for servers that send precompressed files.", action="store_true")
+parser.add_argument('--diff', help="Only rewrite files whose content changed, and remove ones that are no longer produced.", action="store_true")
+parser.add_argument('--thumbnails', help="Point hover previews and page icons at scaled-down copies of the images (needs Pillow).", action="store_true")
+parser.add_argument('--stage', help="Build in a hidden directory next to the output and move the result into place once it's done.", action="store_true")
+parser.add_argument('--stage-dir', help="Like --stage, but build in a new directory inside DIR (e.g. on faster local disk).", default=None, metavar="DIR")
 
 
 args = parser.parse_args()
-build_viewer(args.path, args.dataset)
+# Minifying, compressing and diffing report what they saved through the profile
+profile = build_viewer(args.path, args.dataset, incremental=args.incremental, workers=args.jobs,
+                       column_workers=args.threads, link_assets=args.link_assets, stream=args.stream, mode=args.mode,
+                       profile=args.profile or args.profile_json is not None or args.minify or args.compress or args.diff,
+                       minify=args.minify, compress=args.compress, diff=args.diff, stage=args.stage_dir or args.stage,
+                       thumbnails=args.thumbnails)
+if args.profile:
+    print(profile.report())
+elif profile is not None and profile.savings():
+    print("\n".join(profile.savings()))
+if args.profile_json is not None:
+    profile.dump(args.profile_json)
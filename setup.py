@@ -10,7 +10,9 @@ setup(
     description="Framework for building web pages to examine output.",
     author="Zeshawn Shaheen",
     author_email="shaheen2@llnl.gov",
+    python_requires=">=3.6",
     install_requires=["requests"],
+    extras_require={"thumbnails": ["Pillow"]},
     packages=find_packages(),
     include_package_data=True,
     scripts=["scripts/view_output", "scripts/view_output.py", "scripts/upload_output", "scripts/upload_output.py", "scripts/login_viewer", "scripts/login_viewer.py", "scripts/quick_view", "scripts/quick_view.py"]
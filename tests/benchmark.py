@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+"""
+End-to-end build benchmark.
+
+Generates a synthetic package (N pages x G groups x R rows x C columns, with
+placeholder PNGs), then times build_viewer and build_page on it in a fresh
+process each, recording wall time, files and bytes written, and peak RSS.
+
+    python tests/benchmark.py --pages 4 --groups 5 --rows 200 --columns 6 -o results.json
+    python tests/benchmark.py ... --compare old_results.json
+
+Runs offline, with nothing beyond the standard library and output_viewer.
+"""
+from argparse import ArgumentParser
+import multiprocessing
+import tracemalloc
+import resource
+import struct
+import shutil
+import json
+import time
+import zlib
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from output_viewer import __version__
+from output_viewer.index import OutputIndex, OutputPage, OutputGroup, OutputRow, OutputFile
+
+
+def placeholder_png(size=16):
+    """
+    A valid grayscale PNG of size x size pixels.
+    """
+    def chunk(kind, data):
+        body = kind + data
+        return struct.pack(">I", len(data)) + body + struct.pack(">I", zlib.crc32(body) & 0xffffffff)
+    rows = b"".join(b"\x00" + bytes((x * 255 // size) for x in range(size)) for _ in range(size))
+    header = struct.pack(">IIBBBBB", size, size, 8, 0, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(rows)) + chunk(b"IEND", b"")
+
+
+def generate_package(root, pages=2, groups=2, rows=10, columns=4, image_size=16):
+    """
+    Write a synthetic index.json and its placeholder images to root; returns the index path.
+    """
+    if os.path.exists(root):
+        shutil.rmtree(root)
+    plots = os.path.join(root, "plots")
+    os.makedirs(plots)
+    png = placeholder_png(image_size)
+
+    index = OutputIndex("Benchmark Package", version="benchmark")
+    for p in range(pages):
+        page = OutputPage("Page %d" % p, columns=["Column %d" % c for c in range(columns)],
+                          short_name="page%d" % p, icon=os.path.join("plots", "icon%d.png" % p))
+        with open(os.path.join(root, page.icon), "wb") as f:
+            f.write(png)
+        for g in range(groups):
+            page.addGroup(OutputGroup("Group %d" % g))
+            for r in range(rows):
+                cols = []
+                for c in range(columns):
+                    path = os.path.join("plots", "p%d_g%d_r%d_c%d.png" % (p, g, r, c))
+                    with open(os.path.join(root, path), "wb") as f:
+                        f.write(png)
+                    cols.append(OutputFile(path, title="Column %d" % c, meta={"page": str(p), "row": str(r)},
+                                           other_files=[{"url": path.replace(".png", ".nc")}]))
+                page.addRow(OutputRow("Row %d" % r, cols), g)
+        index.addPage(page)
+    index_path = os.path.join(root, "index.json")
+    index.toJSON(index_path)
+    return index_path
+
+
+def tree_stats(root):
+    """
+    Map of path -> (size, mtime_ns) for every file under root.
+    """
+    stats = {}
+    for dirpath, _, files in os.walk(root):
+        for f in files:
+            path = os.path.join(dirpath, f)
+            st = os.stat(path)
+            stats[path] = (st.st_size, st.st_mtime_ns)
+    return stats
+
+
+def tree_memory(rows=1000, columns=4):
+    """
+    Memory held by the HTMLBuilder table a page of rows x columns links builds, measured with tracemalloc.
+    """
+    from output_viewer.htmlbuilder import Table, TableCell, Link
+
+    tracemalloc.start()
+    table = Table(class_="table")
+    nodes = 1
+    for r in range(rows):
+        tr = table.append_row(class_="output-row")
+        cell = TableCell()
+        cell.append("Row %d" % r)
+        tr.append(cell)
+        for c in range(columns):
+            link = Link(href="group/row_%d/column_%d.html" % (r, c), data={"preview": "../plots/%d_%d.png" % (r, c)})
+            link.append("Column %d" % c)
+            tr.append_cell(link, colspan="1")
+        nodes += 2 + 2 * columns
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return {"nodes": nodes, "bytes": size, "bytes_per_node": size / float(nodes)}
+
+
+def _run(queue, func_name, args, kwargs):
+    from output_viewer import build
+    from output_viewer.index import OutputPage
+
+    if func_name == "build_page":
+        args = (OutputPage(args[0], short_name=args[0]),) + tuple(args[1:])
+    start = time.perf_counter()
+    getattr(build, func_name)(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+    queue.put((elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+
+def measure(root, func_name, args, kwargs):
+    """
+    Run output_viewer.build.<func_name>(*args, **kwargs) in a fresh process and return its measurements.
+    """
+    before = tree_stats(root)
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    proc = ctx.Process(target=_run, args=(queue, func_name, args, kwargs))
+    proc.start()
+    elapsed, peak_rss = queue.get()
+    proc.join()
+    after = tree_stats(root)
+
+    written = [path for path, stat in after.items() if before.get(path) != stat]
+    return {
+        "wall_time": elapsed,
+        "files_written": len(written),
+        "bytes_written": sum(after[path][0] for path in written),
+        "files_removed": len(set(before) - set(after)),
+        "peak_rss_kb": peak_rss,
+    }
+
+
+def run_benchmark(root, pages=2, groups=2, rows=10, columns=4, repeat=1, build_kwargs=None):
+    build_kwargs = build_kwargs or {}
+    index_path = generate_package(root, pages, groups, rows, columns)
+    results = {
+        "output_viewer_version": __version__,
+        "python": sys.version.split()[0],
+        "package": {"pages": pages, "groups": groups, "rows": rows, "columns": columns},
+        "build_kwargs": build_kwargs,
+        "runs": {},
+        "tree_memory": tree_memory(rows, columns),
+    }
+    page_kwargs = dict((k, v) for k, v in build_kwargs.items() if k in ("column_workers", "link_assets", "mode"))
+    cases = [
+        ("build_viewer", "build_viewer", (index_path,), build_kwargs),
+        # A second build over the existing tree
+        ("rebuild_viewer", "build_viewer", (index_path,), build_kwargs),
+        ("build_page", "build_page", ("page0", index_path), page_kwargs),
+    ]
+    for name, func_name, args, kwargs in cases:
+        runs = [measure(root, func_name, args, kwargs) for _ in range(repeat)]
+        best = min(runs, key=lambda run: run["wall_time"])
+        results["runs"][name] = best
+    return results
+
+
+def compare(old, new):
+    lines = []
+    for name, run in sorted(new["runs"].items()):
+        if name not in old["runs"]:
+            continue
+        before = old["runs"][name]
+        for key in ("wall_time", "files_written", "peak_rss_kb"):
+            if before[key]:
+                lines.append("%-16s %-14s %12.3f -> %12.3f (%+.1f%%)" % (
+                    name, key, before[key], run[key], 100.0 * (run[key] - before[key]) / before[key]))
+    if "tree_memory" in old and "tree_memory" in new:
+        before, after = old["tree_memory"]["bytes_per_node"], new["tree_memory"]["bytes_per_node"]
+        lines.append("%-16s %-14s %12.3f -> %12.3f (%+.1f%%)" % (
+            "tree_memory", "bytes_per_node", before, after, 100.0 * (after - before) / before))
+    return "\n".join(lines)
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark output_viewer builds on a synthetic package.")
+    parser.add_argument("--pages", type=int, default=4)
+    parser.add_argument("--groups", type=int, default=4)
+    parser.add_argument("--rows", type=int, default=100)
+    parser.add_argument("--columns", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=1, help="Keep the best of this many runs of each case.")
+    parser.add_argument("--root", default=os.path.join("/tmp", "output_viewer_benchmark"),
+                        help="Where to generate the package.")
+    parser.add_argument("--build-kwargs", default="{}", help="JSON object of extra build_viewer arguments.")
+    parser.add_argument("-o", "--output", help="Write the results to this JSON file.")
+    parser.add_argument("--compare", help="Previous results JSON to compare against.")
+    args = parser.parse_args()
+
+    results = run_benchmark(args.root, args.pages, args.groups, args.rows, args.columns, args.repeat,
+                            json.loads(args.build_kwargs))
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            print(compare(json.load(f), results))
+
+
+if __name__ == "__main__":
+    main()
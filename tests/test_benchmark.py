@@ -0,0 +1,14 @@
+from benchmark import run_benchmark, compare
+import os
+
+
+def test_benchmark_smoke(tmp_path):
+    results = run_benchmark(str(tmp_path / "package"), pages=1, groups=1, rows=2, columns=2)
+    first = results["runs"]["build_viewer"]
+    # 1 page index + 4 column pages + the top-level index + manifest + static assets
+    assert first["files_written"] > 6
+    assert first["peak_rss_kb"] > 0
+    # The page index, 4 column pages, and the manifest entry it invalidates
+    assert results["runs"]["build_page"]["files_written"] == 6
+    assert results["tree_memory"]["bytes_per_node"] > 0
+    assert "build_viewer" in compare(results, results)
@@ -0,0 +1,400 @@
+from output_viewer.index import OutputIndex, OutputPage, OutputGroup, OutputRow, OutputFile
+from output_viewer.build import build_viewer, build_page, open_specs, clear_spec_cache
+import gzip
+import json
+import marshal
+import os
+
+
+def make_index(root, pages=2, rows=3):
+    """
+    Write a small package with an index.json and placeholder images to root.
+    """
+    os.makedirs(os.path.join(root, "plots"))
+    ind = OutputIndex("Test Package", version="test")
+    for p in range(pages):
+        page = OutputPage("Page %d" % p, columns=["Col A", "Col B"], short_name="page%d" % p)
+        page.addGroup(OutputGroup("Group"))
+        for r in range(rows):
+            cols = []
+            for c in range(2):
+                path = os.path.join("plots", "p%d_r%d_c%d.png" % (p, r, c))
+                with open(os.path.join(root, path), "wb") as f:
+                    f.write(b"png")
+                cols.append(OutputFile(path, title="Col %d" % c, meta={"row": str(r)}))
+            page.addRow(OutputRow("Row %d" % r, cols), 0)
+        ind.addPage(page)
+    index_path = os.path.join(root, "index.json")
+    ind.toJSON(index_path)
+    return index_path
+
+
+def test_incremental_skips_unchanged_pages(tmp_path):
+    index_path = make_index(str(tmp_path))
+    build_viewer(index_path)
+    page0 = os.path.join(str(tmp_path), "page0", "index.html")
+    page1 = os.path.join(str(tmp_path), "page1", "index.html")
+    os.utime(page0, (0, 0))
+    os.utime(page1, (0, 0))
+
+    with open(index_path) as f:
+        spec = json.load(f)
+    spec["specification"][1]["title"] = "Renamed"
+    with open(index_path, "w") as f:
+        json.dump(spec, f)
+
+    build_viewer(index_path, incremental=True)
+    assert os.stat(page0).st_mtime == 0
+    assert os.stat(page1).st_mtime != 0
+    with open(page1) as f:
+        assert "Renamed" in f.read()
+
+
+def test_incremental_rebuilds_pages_when_menu_reordered(tmp_path):
+    index_path = make_index(str(tmp_path))
+    with open(index_path) as f:
+        spec = json.load(f)
+    spec["menu"] = [{"title": "First", "url": "first.html"}, {"title": "Second", "url": "second.html"}]
+    with open(index_path, "w") as f:
+        json.dump(spec, f)
+    build_viewer(index_path)
+
+    spec["menu"].reverse()
+    with open(index_path, "w") as f:
+        json.dump(spec, f)
+    build_viewer(index_path, incremental=True)
+    with open(os.path.join(str(tmp_path), "page0", "index.html")) as f:
+        html = f.read()
+    assert html.index("second.html") < html.index("first.html")
+
+
+def test_parallel_build_matches_serial(tmp_path):
+    serial = make_index(str(tmp_path / "serial"), pages=3)
+    parallel = make_index(str(tmp_path / "parallel"), pages=3)
+    build_viewer(serial)
+    build_viewer(parallel, workers=3)
+    for page in ("page0", "page1", "page2"):
+        with open(os.path.join(str(tmp_path / "serial"), page, "index.html")) as s:
+            with open(os.path.join(str(tmp_path / "parallel"), page, "index.html")) as p:
+                assert s.read() == p.read()
+
+
+def test_worker_pages_share_a_snapshot(tmp_path, monkeypatch):
+    from output_viewer import build, utils
+
+    index_path = make_index(str(tmp_path), pages=2)
+    scanned = []
+    real_scan = utils.FileSnapshot._scan
+    monkeypatch.setattr(utils.FileSnapshot, "_scan", lambda self, dirpath: scanned.append(dirpath) or real_scan(self, dirpath))
+    monkeypatch.setattr(build, "_worker_snapshot", None)
+    for plotspec in open_specs(index_path)["specification"]:
+        build._build_page_worker(plotspec, str(tmp_path), None, None, plotspec["short_name"], None, "pages",
+                                 build.OutputWriter(), False)
+    assert scanned.count(os.path.join(str(tmp_path), "plots")) == 1
+
+
+def test_column_errors_reported_per_file(tmp_path, monkeypatch):
+    from output_viewer import page
+
+    index_path = make_index(str(tmp_path), pages=1)
+    real_build = page.Column.build
+
+    def flaky_build(self, toolbar, template=None):
+        if self.title == "Col 1":
+            raise IOError("disk full")
+        real_build(self, toolbar, template)
+
+    monkeypatch.setattr(page.Column, "build", flaky_build)
+    try:
+        build_viewer(index_path, column_workers=4)
+    except page.BuildError as e:
+        failed = sorted(os.path.basename(path) for path, _ in e.failures)
+        assert failed == ["bcol-1.html"] * 3
+    else:
+        assert False, "BuildError not raised"
+
+
+def test_staged_build(tmp_path, monkeypatch):
+    from output_viewer import page
+    from output_viewer.build import staging_path
+
+    root = os.path.join(str(tmp_path), "package")
+    os.mkdir(root)
+    index_path = make_index(root, pages=2)
+    build_viewer(index_path)
+    live = dict((name, open(os.path.join(root, name)).read())
+                for name in ("index.html", os.path.join("page0", "index.html"), os.path.join("page1", "index.html")))
+
+    # A failed staged build leaves the live tree as it was
+    real_build = page.Page.build
+
+    def failing_build(self, dirname, toolbar=None, lazy=False):
+        real_build(self, dirname, toolbar, lazy)
+        if dirname == "page1":
+            raise IOError("disk full")
+
+    monkeypatch.setattr(page.Page, "build", failing_build)
+    try:
+        build_viewer(index_path, stage=True, minify=True)
+    except IOError:
+        pass
+    else:
+        assert False, "IOError not raised"
+    for name, html in live.items():
+        with open(os.path.join(root, name)) as f:
+            assert f.read() == html
+    assert os.path.isdir(staging_path(root))
+
+    # A given staging directory is shared: only the build's own directory in it is removed
+    stage = os.path.join(str(tmp_path), "stage")
+    os.mkdir(stage)
+    with open(os.path.join(stage, "important.txt"), "w") as f:
+        f.write("keep")
+    try:
+        build_viewer(index_path, stage=stage)
+    except IOError:
+        pass
+    else:
+        assert False, "IOError not raised"
+    assert os.listdir(stage) == ["important.txt"]
+    monkeypatch.setattr(page.Page, "build", real_build)
+
+    build_viewer(index_path, stage=stage, minify=True, compress=True)
+    assert os.listdir(stage) == ["important.txt"]
+    with open(os.path.join(root, "page0", "index.html")) as f:
+        assert "</td>" not in f.read()
+    assert os.path.exists(os.path.join(root, "index.html.gz"))
+    assert os.path.exists(os.path.join(root, "page1", "bgroup", "brow-2", "bcol-1.html"))
+
+    build_viewer(index_path, stage=True)
+    assert not os.path.exists(staging_path(root))
+    assert not os.path.exists(os.path.join(root, "index.html.gz"))
+    for name, html in live.items():
+        with open(os.path.join(root, name)) as f:
+            assert f.read() == html
+
+
+def test_static_assets_only_copied_when_changed(tmp_path):
+    from output_viewer.build import copy_and_edit_path
+
+    path = str(tmp_path)
+    viewer_js = os.path.join(path, "viewer", "js", "viewer.js")
+    copy_and_edit_path(path, None)
+    inode = os.stat(viewer_js).st_ino
+    copy_and_edit_path(path, None)
+    assert os.stat(viewer_js).st_ino == inode
+
+    copy_and_edit_path(path, None, link_assets="symlink")
+    assert os.path.islink(viewer_js)
+    copy_and_edit_path(path, None)
+    assert not os.path.islink(viewer_js)
+    assert os.path.exists(viewer_js)
+
+
+def test_static_assets_fingerprinted(tmp_path):
+    from output_viewer.build import copy_and_edit_path
+    from output_viewer.assets import static_url
+
+    index_path = make_index(str(tmp_path), pages=1)
+    build_viewer(index_path)
+    fingerprinted = static_url("js/viewer.js")
+    assert fingerprinted.startswith("js/viewer.") and fingerprinted != "js/viewer.js"
+    viewer_dir = os.path.join(str(tmp_path), "viewer")
+    with open(os.path.join(viewer_dir, fingerprinted)) as f, open(os.path.join(viewer_dir, "js", "viewer.js")) as g:
+        assert f.read() == g.read()
+    with open(os.path.join(str(tmp_path), "page0", "index.html")) as f:
+        assert 'src="../viewer/%s"' % fingerprinted in f.read()
+
+    copy_and_edit_path(str(tmp_path), None, link_assets="symlink")
+    assert os.path.islink(os.path.join(viewer_dir, fingerprinted))
+
+
+def test_old_fingerprinted_assets_kept_through_upgrade(tmp_path, monkeypatch):
+    from output_viewer import build
+
+    path = str(tmp_path)
+    viewer_dir = os.path.join(path, "viewer")
+    build.copy_and_edit_path(path, None)
+    old = build.static_fingerprints()["js/viewer.js"]
+
+    # As if the package were upgraded and its assets changed, twice
+    for version in ("2", "3"):
+        monkeypatch.setattr(build, "static_checksum", lambda: version)
+        monkeypatch.setattr(build, "static_fingerprints", lambda: {"js/viewer.js": "js/viewer.v%s.js" % version})
+        build.copy_and_edit_path(path, None)
+        assert os.path.exists(os.path.join(viewer_dir, "js", "viewer.v%s.js" % version))
+        if version == "2":
+            # Pages that haven't been rebuilt yet still have their assets
+            assert os.path.exists(os.path.join(viewer_dir, old))
+    # but only for one refresh
+    assert not os.path.exists(os.path.join(viewer_dir, old))
+    assert os.path.exists(os.path.join(viewer_dir, "js", "viewer.v2.js"))
+
+
+def test_build_page_uses_cached_specs(tmp_path):
+    index_path = make_index(str(tmp_path), pages=3)
+    spec = open_specs(index_path, sidecar=True)
+    assert open_specs(index_path) is spec
+    assert os.path.exists(index_path + ".marshal")
+
+    page = OutputPage("Page 2", short_name="page2")
+    assert build_page(page, index_path) == os.path.join("page2", "index.html")
+    assert os.path.exists(os.path.join(str(tmp_path), "page2", "index.html"))
+    assert not os.path.exists(os.path.join(str(tmp_path), "page0"))
+    try:
+        build_page(page, index_path, profile=True)
+    except ValueError:
+        pass
+    else:
+        assert False, "ValueError not raised"
+
+    # Only the latest index is kept, and it can be dropped
+    other_path = make_index(os.path.join(str(tmp_path), "other"), pages=1)
+    open_specs(other_path)
+    assert open_specs(index_path) is not spec
+    spec = open_specs(index_path)
+    clear_spec_cache()
+    assert open_specs(index_path) is not spec
+
+    # Other processes load the sidecar instead of the JSON
+    os.remove(index_path + ".marshal")
+    clear_spec_cache()
+    build_page(page, index_path, default_mask=0o640, sidecar=True)
+    assert os.stat(index_path + ".marshal").st_mode & 0o777 == 0o640
+    clear_spec_cache()
+    with open(index_path + ".marshal", "rb") as f:
+        key, sidecar_spec = marshal.load(f)
+    sidecar_spec["title"] = "From the sidecar"
+    with open(index_path + ".marshal", "wb") as f:
+        marshal.dump((key, sidecar_spec), f)
+    assert open_specs(index_path, sidecar=True)["title"] == "From the sidecar"
+
+
+def test_build_page_invalidates_manifest_entry(tmp_path):
+    from output_viewer.manifest import MANIFEST_NAME
+
+    index_path = make_index(str(tmp_path), pages=2)
+    build_viewer(index_path, default_mask=0o640)
+    build_page(OutputPage("Page 1", short_name="page1"), index_path)
+    manifest_path = os.path.join(str(tmp_path), MANIFEST_NAME)
+    with open(manifest_path) as f:
+        assert list(json.load(f)["pages"]) == ["page0"]
+    assert os.stat(manifest_path).st_mode & 0o777 == 0o640
+    assert [name for name in os.listdir(str(tmp_path)) if ".tmp-" in name] == []
+
+
+def test_spa_mode_writes_one_page_and_data(tmp_path):
+    index_path = make_index(str(tmp_path), pages=1)
+    build_viewer(index_path, mode="spa")
+    page_dir = os.path.join(str(tmp_path), "page0")
+    assert sorted(os.listdir(page_dir)) == ["data.json", "index.html"]
+    with open(os.path.join(page_dir, "data.json")) as f:
+        data = json.load(f)
+    row = data["groups"][0]["rows"][1]
+    assert row["title"] == "Row 1"
+    assert row["cells"][0]["url"] == "bgroup/brow-1/bcol-0.html"
+    assert row["cells"][0]["files"][0] == ["../plots/p0_r1_c0.png", "File Shown"]
+    with open(os.path.join(page_dir, "index.html")) as f:
+        assert 'class="spa_view" data-src="data.json"' in f.read()
+
+
+def test_lazy_mode_writes_group_rows_separately(tmp_path):
+    root = str(tmp_path)
+    index_path = make_index(root, pages=1)
+    build_viewer(index_path)
+    with open(os.path.join(root, "page0", "index.html")) as f:
+        full = f.read()
+
+    build_viewer(index_path, mode="lazy")
+    with open(os.path.join(root, "page0", "index.html")) as f:
+        lazy = f.read()
+    with open(os.path.join(root, "page0", "bgroup", "rows.html")) as f:
+        rows = f.read()
+    assert 'class="output-row"' not in lazy
+    assert rows.startswith('<tr class="output-row">') and rows.count("<tr") == 3
+    assert os.path.exists(os.path.join(root, "page0", "bgroup", "brow-1", "bcol-0.html"))
+    # Putting the rows back under their header gives the full table
+    header_end = lazy.index("</tr>", lazy.index('<tr data-rows="bgroup/rows.html">')) + len("</tr>")
+    assert (lazy[:header_end] + rows + lazy[header_end:]).replace(' data-rows="bgroup/rows.html"', "") == full
+
+
+def test_diff_only_rewrites_changed_files(tmp_path):
+    root = str(tmp_path)
+    index_path = make_index(root, pages=1)
+    build_viewer(index_path)
+    row_page = os.path.join(root, "page0", "bgroup", "brow-2", "bcol-0.html")
+    os.utime(row_page, (0, 0))
+
+    profile = build_viewer(index_path, diff=True, profile=True)
+    assert (profile.files_written, profile.files_removed) == (0, 0)
+    assert profile.files_unchanged == 8
+    assert os.stat(row_page).st_mtime == 0
+
+    with open(index_path) as f:
+        spec = json.load(f)
+    spec["specification"][0]["rows"][0].pop()
+    with open(index_path, "w") as f:
+        json.dump(spec, f)
+    profile = build_viewer(index_path, diff=True, profile=True)
+    # Only the page's index changes, and the dropped row's column pages go
+    assert profile.files_written == 1 and profile.files_removed == 2
+    assert not os.path.exists(os.path.dirname(row_page))
+
+
+def test_profile_counts_pages_and_files(tmp_path):
+    index_path = make_index(str(tmp_path), pages=2, rows=3)
+    profile = build_viewer(index_path, profile=True)
+    result = profile.to_dict()
+    assert list(result["pages"]) == ["page0", "page1"]
+    # Each page: its index and 3 rows x 2 columns; plus the top-level index
+    assert [page["files_written"] for page in result["pages"].values()] == [7, 7]
+    assert result["files_written"] == 15
+    assert set(["load", "tree", "serialize", "nuke", "write", "assets"]) <= set(result["phases"])
+    assert build_viewer(index_path) is None
+
+
+def test_minify_and_compress(tmp_path):
+    root = str(tmp_path)
+    index_path = make_index(root, pages=1)
+    profile = build_viewer(index_path, minify=True, compress=True, profile=True)
+
+    page = os.path.join(root, "page0", "index.html")
+    with open(page) as f:
+        html = f.read()
+    assert "</td>" not in html and 'class="table"' not in html
+    for path in (page, os.path.join(root, "index.html"), index_path, os.path.join(root, "viewer", "js", "viewer.js")):
+        with gzip.open(path + ".gz", "rb") as compressed, open(path, "rb") as plain:
+            assert compressed.read() == plain.read()
+    assert profile.bytes_minified > 0
+    assert profile.bytes_after_compression < profile.bytes_before_compression
+    assert len(profile.savings()) == 2
+
+    # Without compress, the top-level copies are cleaned up; pages are rebuilt without them
+    build_viewer(index_path)
+    assert not os.path.exists(page + ".gz")
+    assert not os.path.exists(index_path + ".gz")
+    assert not os.path.exists(os.path.join(root, "viewer", "js", "viewer.js.gz"))
+
+
+def test_thumbnails_fall_back_to_full_images(tmp_path):
+    from output_viewer import thumbnails
+
+    root = str(tmp_path)
+    index_path = make_index(root, pages=1, rows=2)
+    if thumbnails.thumbnails_available():
+        thumbnails.Image.new("RGB", (800, 600)).save(os.path.join(root, "plots", "p0_r0_c0.png"))
+    build_viewer(index_path, thumbnails=True, default_mask=0o755)
+    with open(os.path.join(root, "page0", "index.html")) as f:
+        html = f.read()
+
+    # The placeholder images can't be read, so their previews are the images themselves
+    assert 'data-preview="../plots/p0_r1_c0.png"' in html
+    if thumbnails.thumbnails_available():
+        thumb = thumbnails.thumbnail_name(os.path.join("plots", "p0_r0_c0.png"),
+                                          os.stat(os.path.join(root, "plots", "p0_r0_c0.png")))
+        assert 'data-preview="../%s"' % thumb in html
+        assert thumbnails.Image.open(os.path.join(root, thumb)).size == (400, 300)
+        for made in (thumb, thumbnails.THUMBNAIL_DIR):
+            assert os.stat(os.path.join(root, made)).st_mode & 0o777 == 0o755
+    else:
+        assert 'data-preview="../plots/p0_r0_c0.png"' in html
@@ -0,0 +1,212 @@
+from output_viewer.htmlbuilder import HTMLBuilder, Document, Table, TableCell, Link, Span, BootstrapNavbar, parse_fragment
+from output_viewer.assets import static_url
+from xml.etree.ElementTree import TreeBuilder, tostring
+from collections import OrderedDict
+import io
+
+
+def elementtree_html(node):
+    root = TreeBuilder()
+    node.build(root=root)
+    return tostring(root.close(), method="html").decode("utf-8")
+
+
+def make_tree():
+    root = HTMLBuilder("div", class_="outer & \"quoted\"", data={"x": "<1>"})
+    root.append("Text with <markup> & ünïcödé")
+    script = root.append_tag("script", type="text/javascript")
+    script.append("if (a < b && c > d) {}")
+    script.append_tag("span").append("inside")
+    script.append("after <child>")
+    root.append_tag("img", src="a>b.png", alt="")
+    root.append_tag("br")
+    table = Table(class_="table")
+    table.append_header().append_cell("Header", colspan="2")
+    row = table.append_row(class_="output-row")
+    link = Link(href="x.html?a=1&b=2")
+    link.append("Link")
+    row.append_cell(link)
+    row.append_cell(3.5)
+    root.append(table)
+    root.append_tag("style").append("a > b { color: red; }")
+    return root
+
+
+def test_serializer_matches_elementtree():
+    tree = make_tree()
+    assert tree.build() == elementtree_html(tree)
+
+    menu = OrderedDict([("Docs", "docs/index.html"), ("More", OrderedDict([("A", "a.html"), ("B", "b.html")]))])
+    navbar = BootstrapNavbar("Package", "index.html", menu)
+    assert navbar.build() == elementtree_html(navbar)
+
+
+def test_document_serializer():
+    doc = Document(title="Title & <more> é", level=2)
+    doc.append(make_tree())
+    html = doc.build()
+    assert html.startswith("<!DOCTYPE html>\n<html><head><title>Title &amp; &lt;more&gt; &#233;</title>")
+    assert html.endswith("</body></html>")
+    assert '<script type="text/javascript" src="../../viewer/%s"> </script>' % static_url("js/viewer.js") in html
+    assert make_tree().build() in html
+
+
+def test_build_to_streams_same_html():
+    doc = Document(title="Big", level=1)
+    table = Table()
+    doc.append_tag("div", class_="container").append(table)
+    for i in range(50):
+        row = table.append_row(class_="output-row")
+        row.append_cell("Row %d ü" % i)
+        link = Link(href="row%d.html" % i)
+        link.append("Link")
+        row.append_cell(link)
+
+    chunks = list(doc.iter_chunks(chunk_size=16))
+    assert len(chunks) > 2
+    assert "".join(chunks) == doc.build()
+
+    out = io.StringIO()
+    assert doc.build_to(out) == len(doc.build())
+    assert out.getvalue() == doc.build()
+    assert "".join(table.iter_chunks(chunk_size=16)) == table.build()
+
+
+def test_bulk_rows_match_nodes():
+    colspans = ["2", "1"]
+    rows = []
+    for i in range(30):
+        cells = [("a", {"href": "r%d.html?a&b" % i, "data-preview": "../r%d.png" % i}, "Link <%d>" % i),
+                 ("span", None, "Missing ü") if i % 3 else i * 1.5,
+                 "Past the last column"]
+        rows.append(("<span>Row <b>%d</b></span>" % i, cells))
+
+    nodes = Table(class_="table")
+    for title, cells in rows:
+        tr = nodes.append_row(class_="output-row")
+        cell = TableCell()
+        cell.append_formatted(title)
+        tr.append(cell)
+        for colspan, value in zip(colspans, cells):
+            if isinstance(value, tuple):
+                node = Link(href=value[1]["href"], data={"preview": value[1]["data-preview"]}) if value[0] == "a" else Span()
+                node.append(value[2])
+                value = node
+            tr.append_cell(value, colspan=colspan)
+
+    bulk = Table(class_="table")
+    bulk.append_rows(rows, colspans, class_="output-row")
+    assert bulk.build() == nodes.build()
+    assert elementtree_html(bulk) == elementtree_html(nodes)
+    assert "".join(bulk.iter_chunks(chunk_size=16)) == nodes.build()
+    assert len(list(bulk.iter_chunks(chunk_size=16))) > 2
+    assert bulk.find("tr") == [] and bulk.index().by_class("output-row") == []
+
+
+def test_compact_nodes():
+    link = Link(href="a.html", class_="btn", data={"preview": "a.png"})
+    assert not hasattr(link, "__dict__")
+    assert link.children == ()
+    assert link.attrs() == {"href": "a.html", "class": "btn", "data-preview": "a.png"}
+    link.set_attr("href", "b.html")
+    assert link.get_attr("href") == "b.html"
+    assert link.build() == '<a href="b.html" class="btn" data-preview="a.png"></a>'
+    assert not hasattr(Document(), "__dict__")
+
+    # Subclasses can still set up their children directly
+    class Legacy(HTMLBuilder):
+        def __init__(self):
+            super(Legacy, self).__init__("ul")
+            self.children = []
+            self.children.append(HTMLBuilder("li"))
+
+    legacy = Legacy()
+    legacy.append_tag("li")
+    assert legacy.build() == "<ul><li></li><li></li></ul>"
+
+
+def test_formatted_fragments():
+    parse_fragment.cache_clear()
+    row = Table().append_row()
+    for i in range(3):
+        cell = TableCell()
+        cell.append_formatted("<span>Row <b>1</b></span>")
+        row.append(cell)
+    cell = TableCell()
+    cell.append_formatted("<span>Row & 2</span>")
+    cell.append_formatted("Plain > text")
+    cell.append_formatted("<span>Row 3</span>")
+    row.append(cell)
+
+    html = row.build()
+    assert html == elementtree_html(row)
+    assert html.count("<td><span>Row <b>1</b></span></td>") == 3
+    assert "<td>&lt;span&gt;Row &amp; 2&lt;/span&gt;Plain &gt; text<span>Row 3</span></td>" in html
+    # Each distinct string is only parsed once
+    assert parse_fragment.cache_info().misses == 4
+
+
+def test_navbar_at_level():
+    menu = OrderedDict([("Docs", "docs/index.html"), ("Page", "../page/index.html"), ("Abs", "/abs.html")])
+    navbar = BootstrapNavbar("Package", "index.html", menu)
+    original = navbar.build()
+
+    rendered = navbar.at_level(2)
+    assert navbar.build() == original
+    assert navbar.at_level(2) is rendered
+    assert 'href="../../page/index.html"' in rendered.build()
+    assert 'href="/abs.html"' in rendered.build()
+
+    navbar.setLevel(2)
+    assert rendered.build() == navbar.build()
+    doc = Document(level=2)
+    doc.append(rendered)
+    assert navbar.build() in doc.build()
+    assert elementtree_html(rendered) == rendered.build()
+
+
+def test_find_and_index():
+    root = make_tree()
+    links = root.find("a")
+    assert [l.get_attr("href") for l in links] == ["x.html?a=1&b=2"]
+    assert [n.tagname() for n in root.iter_descendants()][:4] == ["script", "span", "img", "br"]
+
+    index = root.index()
+    assert root.index() is index
+    assert index.by_tag("a") == links
+    assert index.by_class("outer") == [root]
+
+    # Appends anywhere in the tree are picked up
+    table = root.find("table")[0]
+    row = table.append_row(class_="output-row extra")
+    link = Link(href="y.html", data={"preview": "y.png"})
+    row.append_cell(link)
+    assert index.by_tag("a") == links + [link]
+    assert set(index.by_class("output-row")) == set(root.find("tr")[1:])
+    assert index.by_class("extra") == [row]
+    assert index.by_attr("data-preview", "y.png") == [link]
+
+    link.set_attr("data-preview", "z.png")
+    assert index.by_attr("data-preview", "y.png") == []
+    assert index.by_attr("data-preview") == [link]
+
+    try:
+        table.index()
+        assert False, "Expected ValueError"
+    except ValueError:
+        pass
+
+
+def test_document_head_cache():
+    first, second = Document(title="One", level=3), Document(title="Two", level=3)
+    assert first.head_assets() is second.head_assets()
+    assert first.build().replace("One", "Two") == second.build()
+
+    second.append_script("extra.js")
+    second.append_style("extra.css")
+    second.append_meta({"name": "robots", "content": "none"})
+    html = second.build()
+    assert '<script type="text/javascript" src="extra.js"> </script></head>' in html
+    assert '<link rel="stylesheet" href="extra.css" type="text/css">' in html
+    assert '<meta name="robots" content="none">' in html
+    assert "extra.js" not in Document(level=3).build()
@@ -0,0 +1,62 @@
+from output_viewer.output import HTMLMinifier, OutputWriter
+from output_viewer.profiling import BuildProfile
+import os
+
+
+PAGE = ('<!DOCTYPE html>\n<html><head><title>A  \n title</title>'
+        '<script type="text/javascript" src="a.js"> </script>'
+        '<script type="text/javascript">if (a < b &&  c > "d") {}</script>'
+        '<link rel="stylesheet" href="a.css" type="text/css"></head>'
+        '<body><pre>  keep\n  this </pre><table class="table"><tr><td colspan="1">'
+        '<a href="x.html?a=1&amp;b=2" data-preview="../x y.png">A</a></td><td>B</td></tr></table>'
+        '<ul><li>One</li><li>Two</li></ul></body></html>')
+
+MINIFIED = ('<!DOCTYPE html> <html><head><title>A title</title>'
+            '<script src=a.js> </script>'
+            '<script>if (a < b &&  c > "d") {}</script>'
+            '<link rel=stylesheet href=a.css></head>'
+            '<body><pre>  keep\n  this </pre><table class=table><tr><td colspan=1>'
+            '<a href="x.html?a=1&amp;b=2" data-preview="../x y.png">A</a><td>B</table>'
+            '<ul><li>One<li>Two</ul></body></html>')
+
+
+def test_minifier():
+    minifier = HTMLMinifier()
+    assert "".join(minifier.minify([PAGE])) == MINIFIED
+    assert minifier.bytes_in - minifier.bytes_out == len(PAGE) - len(MINIFIED)
+
+
+def test_minifier_chunk_boundaries():
+    # Splitting the input anywhere doesn't change the result
+    for size in range(1, 12):
+        chunks = [PAGE[i:i + size] for i in range(0, len(PAGE), size)]
+        assert "".join(HTMLMinifier().minify(chunks)) == MINIFIED
+
+
+def test_diff_writer(tmp_path):
+    root = str(tmp_path)
+    writer = OutputWriter(diff=True)
+    profile = BuildProfile()
+    page_dir = os.path.join(root, "page")
+    writer.prepare_dir(page_dir)
+    writer.prepare_dir(os.path.join(page_dir, "empty"))
+    for name in ("same", "longer", "shorter", "changed"):
+        writer.write_chunks(os.path.join(page_dir, name), ["abc", "def"], profile)
+    writer.write_file(os.path.join(page_dir, "stale"), "old", profile)
+    writer.sweep(page_dir, profile)
+    assert (profile.files_written, profile.files_unchanged, profile.files_removed) == (5, 0, 0)
+    os.utime(os.path.join(page_dir, "same"), (0, 0))
+
+    # Split differently, so chunks don't line up with what was compared before
+    writer.prepare_dir(page_dir)
+    writer.write_chunks(os.path.join(page_dir, "same"), ["ab", "cdef"], profile)
+    writer.write_chunks(os.path.join(page_dir, "longer"), ["abc", "defg"], profile)
+    writer.write_chunks(os.path.join(page_dir, "shorter"), ["abc", "de"], profile)
+    writer.write_chunks(os.path.join(page_dir, "changed"), ["abc", "dXf"], profile)
+    writer.sweep(page_dir, profile)
+    assert (profile.files_written, profile.files_unchanged, profile.files_removed) == (8, 1, 1)
+    assert os.stat(os.path.join(page_dir, "same")).st_mtime == 0
+    assert sorted(os.listdir(page_dir)) == ["changed", "longer", "same", "shorter"]
+    for name, content in [("same", "abcdef"), ("longer", "abcdefg"), ("shorter", "abcde"), ("changed", "abcdXf")]:
+        with open(os.path.join(page_dir, name)) as f:
+            assert f.read() == content
@@ -0,0 +1,65 @@
+from output_viewer.page import Group, ColumnTemplate
+from output_viewer.htmlbuilder import BootstrapNavbar
+from output_viewer.utils import FileSnapshot
+from collections import OrderedDict
+import os
+
+
+def make_group(root, missing=()):
+    columns = [
+        {"path": "plots/a.png", "title": "Café <a> & \"b\"", "meta": {"k&": "<v>", "n": 3},
+         "files": [{"url": "plots/a.nc"}, {"url": "plots/a.zzz", "title": "Other"}]},
+        "plain text",
+        {"path": "data/b.nc", "title": None},
+        {"path": "plots/c.svg", "title": ""},
+    ]
+    for c in columns:
+        if isinstance(c, dict) and c["path"] not in missing:
+            path = os.path.join(root, c["path"])
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, "w").close()
+    return Group(root, "page", {"title": "Group"}, [{"title": "Row", "columns": columns}])
+
+
+def test_column_template_matches_document(tmp_path):
+    menu = OrderedDict([("Docs", "docs/index.html"), ("More", OrderedDict([("A", "a.html"), ("B", "/b.html")]))])
+    toolbar = BootstrapNavbar("Package & co", "index.html", menu)
+    template = ColumnTemplate(toolbar)
+    row = make_group(str(tmp_path)).rows[0]
+    assert [col.prev for col in row.cols.values()] == [None, row.cols[0], row.cols[2]]
+    for col in row.cols.values():
+        assert template.render(col) == col.document(toolbar).build()
+        assert ColumnTemplate().render(col) == col.document(None).build()
+
+
+def test_missing_columns_are_skipped(tmp_path):
+    root = str(tmp_path)
+    group = make_group(root, missing=("data/b.nc",))
+    row = group.rows[0]
+    assert [col.exists() for col in row.cols.values()] == [True, False, True]
+    assert [col.prev for col in row.cols.values()] == [None, None, row.cols[0]]
+    assert row.cols[0].next is row.cols[3]
+
+    os.mkdir(os.path.join(root, "page"))
+    group.build(None)
+    assert os.path.exists(row.cols[0].getFilePath())
+    assert not os.path.exists(row.cols[2].getFilePath())
+    assert os.path.exists(row.cols[3].getFilePath())
+
+
+def test_file_snapshot(tmp_path):
+    root = str(tmp_path)
+    os.mkdir(os.path.join(root, "dir"))
+    open(os.path.join(root, "dir", "a.png"), "w").close()
+    os.symlink("nowhere", os.path.join(root, "dir", "broken"))
+
+    snapshot = FileSnapshot()
+    assert snapshot.exists(os.path.join(root, "dir", "a.png"))
+    assert snapshot.exists(os.path.join(root, "dir", "..", "dir"))
+    assert not snapshot.exists(os.path.join(root, "dir", "broken"))
+    assert not snapshot.exists(os.path.join(root, "nope", "a.png"))
+    # Each directory is only scanned once
+    open(os.path.join(root, "dir", "b.png"), "w").close()
+    assert not snapshot.exists(os.path.join(root, "dir", "b.png"))
+    assert FileSnapshot().exists(os.path.join(root, "dir", "b.png"))
@@ -0,0 +1,30 @@
+from output_viewer.streaming import iter_index
+import io
+import json
+
+
+def test_iter_index_matches_json_load():
+    index = {
+        "title": "Streaming \"test\"",
+        "specification": [{"title": "Page %d" % i, "rows": [[{"title": "r", "columns": [1.5e3, None, True]}]]}
+                          for i in range(5)],
+        "menu": [{"title": "Menu", "url": "x.html"}],
+    }
+    text = json.dumps(index, indent=2)
+    for chunk_size in (1, 7, 1 << 16):
+        parsed = {"specification": []}
+        for key, value in iter_index(io.StringIO(text), chunk_size):
+            if key == "specification":
+                parsed[key].append(value)
+            else:
+                parsed[key] = value
+        assert parsed == index
+
+
+def test_iter_index_rejects_truncated_files():
+    try:
+        list(iter_index(io.StringIO('{"specification": [{"title": "a"}, '), 4))
+    except ValueError:
+        pass
+    else:
+        assert False, "ValueError not raised"